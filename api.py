@@ -0,0 +1,185 @@
+"""Описание ресурсов JSON API /api/v1 (только чтение).
+
+Поля ресурса — словарь «имя в ответе → путь к атрибуту» строки запроса
+(ORM-объекта или Row); путь через точку идёт по отношениям, которые
+маршрут загрузил жадно, поэтому сериализация не выполняет запросов.
+Коллекции описываются парой (путь, поля элемента). Поле с путём None
+маршрут подставляет сам из отдельно загруженных данных (распределения
+платежей). Параметр ?fields=a,b ограничивает набор полей ответа.
+
+ETag страницы — хэш версий таблиц API из data_version (их увеличивают триггеры
+БД при любой записи, см. models.DataVersion) и параметров запроса. Версии
+читаются одним запросом по первичному ключу до запроса страницы, поэтому ответ
+304 не стоит ни запроса страницы, ни сериализации, и commit из любого процесса
+или соединения сразу меняет ETag.
+"""
+import enum
+import hashlib
+import json
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from models import db, DataVersion, VERSIONED_TABLES
+
+COUNTERPARTY_FIELDS = {
+    'id': 'id',
+    'type': 'type',
+    'full_name': 'full_name',
+    'brand_name': 'brand_name',
+    'inn': 'inn',
+    'contacts': 'contacts',
+    'notes': 'notes',
+}
+
+# Строки contracts_list_query: имена и счётчики уже посчитаны в запросе
+CONTRACT_FIELDS = {
+    'id': 'id',
+    'number': 'number',
+    'date': 'date',
+    'app_end_date': 'app_end_date',
+    'pavilion_number': 'pavilion_number',
+    'status': 'status',
+    'counterparty_id': 'counterparty_id',
+    'counterparty_name': 'counterparty_name',
+    'manager_id': 'manager_id',
+    'manager_name': 'manager_name',
+    'category_id': 'category_id',
+    'specifications_count': 'specifications_count',
+    'realizations_count': 'realizations_count',
+}
+
+SPECIFICATION_SERVICE_FIELDS = {
+    'id': 'id',
+    'description': 'description',
+    'billing_type': 'billing_type',
+    'start_date': 'start_date',
+    'end_date': 'end_date',
+    'amount': 'amount',
+    'service_type': 'service_type.name',
+    'property_object_id': 'property_object_id',
+    'property_object_name': 'property_object.name',
+}
+
+SPECIFICATION_FIELDS = {
+    'id': 'id',
+    'number': 'number',
+    'start_date': 'start_date',
+    'end_date': 'end_date',
+    'description': 'description',
+    'contract_id': 'contract_id',
+    'contract_number': 'contract.number',
+    'counterparty_id': 'contract.counterparty_id',
+    'services': ('services', SPECIFICATION_SERVICE_FIELDS),
+}
+
+REALIZATION_SERVICE_FIELDS = {
+    'id': 'id',
+    'description': 'description',
+    'sale_amount': 'sale_amount',
+    'expense_amount': 'expense_amount',
+    'service_type': 'service_type.name',
+    'property_object_id': 'property_object_id',
+    'property_object_name': 'property_object.name',
+}
+
+REALIZATION_FIELDS = {
+    'id': 'id',
+    'number': 'number',
+    'date': 'date',
+    'source': 'source',
+    'month': 'month',
+    'year': 'year',
+    'counterparty_id': 'counterparty_id',
+    'counterparty_name': 'counterparty.brand_name',
+    'contract_id': 'contract_id',
+    'contract_number': 'contract.number',
+    'specification_id': 'specification_id',
+    'specification_number': 'specification.number',
+    'manager_id': 'manager_id',
+    'manager_name': 'manager.name',
+    'total_sale': 'total_sale',
+    'total_expense': 'total_expense',
+    'total_profit': 'total_profit',
+    'paid_amount': 'paid_amount',
+    'debt': 'debt_amount',
+    'payment_status': 'payment_status',
+    'services': ('services', REALIZATION_SERVICE_FIELDS),
+}
+
+PAYMENT_FIELDS = {
+    'id': 'id',
+    'date': 'date',
+    'payment_type': 'payment_type',
+    'initial_amount': 'initial_amount',
+    'unallocated_amount': 'unallocated_amount',
+    'counterparty_id': 'counterparty_id',
+    'counterparty_name': 'counterparty.brand_name',
+    'contract_id': 'contract_id',
+    'contract_number': 'contract.number',
+    'allocations': None,  # [{realization_id, realization_number, amount}] — отдельным запросом на страницу
+}
+
+
+def select_fields(spec, fields_arg):
+    """Поля ответа из ?fields (через запятую) или все поля ресурса; ValueError для неизвестных."""
+    if not fields_arg:
+        return list(spec)
+    fields = [name.strip() for name in fields_arg.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in spec]
+    if unknown or not fields:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown) or '—'}. Доступны: {', '.join(spec)}.")
+    return fields
+
+
+def to_json(value):
+    """Значение колонки в JSON-совместимый вид: суммы — числа, даты — ISO, перечисления — имя."""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.name
+    return value
+
+
+def _resolve(item, path):
+    for name in path.split('.'):
+        if item is None:
+            return None
+        item = getattr(item, name)
+    return item
+
+
+def serialize(item, spec, fields, **values):
+    """Словарь выбранных полей строки; values — значения полей, которые подставляет маршрут."""
+    result = {}
+    for name in fields:
+        field = spec[name]
+        if name in values:
+            result[name] = values[name]
+        elif isinstance(field, tuple):
+            path, item_spec = field
+            result[name] = [serialize(child, item_spec, list(item_spec)) for child in _resolve(item, path)]
+        else:
+            result[name] = to_json(_resolve(item, field))
+    return result
+
+
+def etag(endpoint, args):
+    """ETag страницы API: версии таблиц API, ресурс и все параметры запроса (поля, фильтры, limit, курсор).
+
+    Версии читаются раньше страницы: если commit попадёт между двумя запросами, новые данные
+    уйдут со старым ETag и следующий запрос просто получит 200, но не наоборот.
+    """
+    versions = db.session.execute(
+        select(DataVersion.table_name, DataVersion.version)
+        .where(DataVersion.table_name.in_(VERSIONED_TABLES))
+        .order_by(DataVersion.table_name)).all()
+    key = [[list(row) for row in versions], endpoint, sorted(args.items(multi=True))]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def dumps(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
@@ -1,15 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, abort,
+                   Response, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+import click
+from sqlalchemy import select, insert, update, bindparam, and_, or_, tuple_, func, union_all, case
+from sqlalchemy.orm import joinedload, selectinload
 import os
+import sys
+import json
+import base64
+import subprocess
+import tempfile
 from datetime import datetime, date, timedelta
 from decimal import Decimal, InvalidOperation
 
+import database
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key' # Добавьте секретный ключ для сессий и флеш-сообщений
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'instance', 'app.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = database.database_uri(
+    os.environ.get('DATABASE_URL'), 'sqlite:///' + os.path.join(basedir, 'instance', 'app.db'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Учёт SQL по запросам: заголовки X-DB-*, панель внизу страниц и /debug/requests
+app.config['SQL_INSTRUMENTATION'] = os.environ.get('SQL_INSTRUMENTATION') == '1'
+app.config['SQL_SLOW_REQUEST_MS'] = int(os.environ.get('SQL_SLOW_REQUEST_MS', 200))
+# Журнал медленных SQL-запросов с планами (0 — выключен)
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 0))
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', os.path.join(basedir, 'instance', 'slow_queries.log'))
 
 from models import (db, User, Counterparty, CounterpartyType, Role,
                     PropertyObject, PropertyObjectType, ServiceType, BusinessCategory,
@@ -17,9 +36,20 @@ from models import (db, User, Counterparty, CounterpartyType, Role,
                     Contract, ContractStatus, Specification, SpecificationService, BillingType,
                     Realization, RealizationService, RealizationSource, PaymentType, PaymentStatus,
                     Payment, payment_realization_association)
+from dictionaries import get_dictionary
+from exports import stream_csv, stream_xlsx
+import api
+import benchmarks
+import instrumentation
+import occupancy
+import placements
+import reports
+import slow_queries
 
 db.init_app(app)
 migrate = Migrate(app, db)
+instrumentation.init_app(app)
+slow_queries.init_app(app)
 
 def parse_date(value: str):
     value = (value or '').strip()
@@ -32,6 +62,80 @@ def parse_date(value: str):
         # Если не получилось, пробуем стандартный формат YYYY-MM-DD
         return datetime.strptime(value, '%Y-%m-%d').date()
 
+PAGE_SIZE = 50
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_cursor(cursor, sort_columns):
+    """Значения ключа сортировки из курсора или None, если курсор некорректен."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(sort_columns):
+            return None
+        return [
+            date.fromisoformat(value) if isinstance(column.type, db.Date) else value
+            for value, column in zip(values, sort_columns)
+        ]
+    except (ValueError, TypeError):
+        return None
+
+def keyset_query(query, sort_columns, cursor=None, descending=False, page_size=PAGE_SIZE):
+    """Запрос одной страницы keyset-пагинации: условие по курсору, сортировка и LIMIT на строку больше."""
+    values = decode_cursor(cursor, sort_columns) if cursor else None
+    if values is not None:
+        key, bound = tuple_(*sort_columns), tuple_(*values)
+        query = query.filter(key < bound if descending else key > bound)
+    order = [column.desc() if descending else column.asc() for column in sort_columns]
+    return query.order_by(*order).limit(page_size + 1)
+
+def keyset_paginate(query, sort_columns, cursor=None, descending=False, page_size=PAGE_SIZE):
+    """Keyset-пагинация запроса по sort_columns (последней должна идти уникальная колонка, обычно id).
+
+    Возвращает (элементы страницы, курсор следующей страницы или None).
+    """
+    items = keyset_query(query, sort_columns, cursor, descending, page_size).all()
+
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in sort_columns])
+    return items, next_cursor
+
+def parse_list_filters():
+    """Фильтры списков из query string; некорректные значения игнорируются."""
+    args = request.args
+    filters = {}
+    for name in ('counterparty_id', 'manager_id'):
+        try:
+            filters[name] = int(args[name])
+        except (KeyError, ValueError):
+            pass
+    for name in ('date_from', 'date_to'):
+        try:
+            value = parse_date(args.get(name))
+        except ValueError:
+            value = None
+        if value:
+            filters[name] = value
+    if args.get('payment_status') in PaymentStatus.__members__:
+        filters['payment_status'] = PaymentStatus[args['payment_status']]
+    if args.get('status') in ContractStatus.__members__:
+        filters['status'] = ContractStatus[args['status']]
+    q = (args.get('q') or '').strip()
+    if q:
+        filters['q'] = q
+    return filters
+
+@app.template_global()
+def page_url(cursor=None):
+    """URL текущего списка с теми же фильтрами и другим курсором."""
+    args = request.args.to_dict()
+    args.pop('cursor', None)
+    if cursor:
+        args['cursor'] = cursor
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
 @app.cli.command('init-db')
 def init_db_command():
     """Initializes the database with dictionary values."""
@@ -69,6 +173,270 @@ def create_manager_command():
     else:
         print("Manager 'Борис' already exists.")
 
+def parse_month(value: str):
+    """Разбирает месяц в формате YYYY-MM, возвращает (year, month)."""
+    year, month = map(int, value.split('-'))
+    if not 1 <= month <= 12:
+        raise ValueError(value)
+    return year, month
+
+@app.cli.command('generate-realizations')
+@click.option('--from', 'from_month', required=True, help='Первый месяц, YYYY-MM.')
+@click.option('--to', 'to_month', required=True, help='Последний месяц включительно, YYYY-MM.')
+@click.option('--chunk-size', default=200, show_default=True, help='Договоров в одной транзакции.')
+def generate_realizations_command(from_month, to_month, chunk_size):
+    """Generates monthly realizations for a range of months.
+
+    Contracts are processed in chunks with a commit after each chunk, so the
+    database is never locked for long. Already generated realizations are
+    skipped, so an interrupted run can simply be started again.
+    """
+    try:
+        start = parse_month(from_month)
+        end = parse_month(to_month)
+    except ValueError:
+        raise click.BadParameter('Месяц указывается в формате YYYY-MM.')
+    if start > end:
+        raise click.BadParameter('--from не может быть позже --to.')
+
+    contract_ids = db.session.scalars(
+        select(Contract.id).where(Contract.status == ContractStatus.ACTIVE).order_by(Contract.id)
+    ).all()
+    chunks = [contract_ids[i:i + chunk_size] for i in range(0, len(contract_ids), chunk_size)]
+
+    total = 0
+    year, month = start
+    while (year, month) <= end:
+        month_total = 0
+        for index, chunk in enumerate(chunks, start=1):
+            month_total += generate_month_realizations(year, month, contract_ids=chunk)
+            db.session.commit()
+            print(f"{month:02}.{year}: chunk {index}/{len(chunks)}, created {month_total}")
+        print(f"{month:02}.{year}: done, created {month_total} realizations.")
+        total += month_total
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    print(f"Total created: {total}.")
+
+
+@app.cli.command('import-placements')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--sheet', 'sheets', multiple=True, type=click.Choice(list(placements.SHEETS)),
+              help='Импортировать только этот лист (можно указать несколько раз).')
+@click.option('--batch-size', default=500, show_default=True, help='Строк книги в одной транзакции.')
+@click.option('--dry-run', is_flag=True, help='Ничего не записывать, только показать план изменений.')
+def import_placements_command(path, sheets, batch_size, dry_run):
+    """Imports contracts and specifications from the placements workbook.
+
+    Counterparties, pavilions, contracts, specifications and monthly placement
+    services that are missing in the database are created in batches; rows
+    that already exist are left untouched and differences are reported.
+    """
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        raise click.ClickException('Для импорта нужен пакет openpyxl: pip install openpyxl')
+    try:
+        importer = placements.PlacementImporter(dry_run=dry_run)
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+
+    errors = []
+    started = datetime.now()
+    importer.run(placements.iter_workbook_rows(path, sheets or list(placements.SHEETS), errors), batch_size)
+    skipped = len(errors) + sum(importer.missing_managers.values())
+
+    if dry_run:
+        for line in importer.diff:
+            print(line)
+    else:
+        for line in importer.diff:
+            if line.startswith('~'):
+                print(line)
+    for error in errors:
+        print(f'! {error}')
+    for name, count in importer.missing_managers.items():
+        print(f'! Менеджер «{name}» не найден, пропущено строк: {count}')
+    created = ', '.join(f'{name}: {count}' for name, count in importer.created.items()) or 'нет'
+    print(f"{'Будет создано' if dry_run else 'Создано'} — {created}. "
+          f"Пропущено строк: {skipped}. Время: {(datetime.now() - started).total_seconds():.1f} с.")
+
+@app.cli.command('allocate-advances')
+@click.option('--counterparty-id', type=int, help='Только этот контрагент (по умолчанию все).')
+def allocate_advances_command(counterparty_id):
+    """Offsets open advances against outstanding realizations, oldest first."""
+    count, amount = allocate_advances(counterparty_id)
+    db.session.commit()
+    print(f'Зачтено {amount:.2f} руб., разнесений: {count}.')
+
+@app.cli.command('rebuild-rollups')
+@click.option('--from', 'from_month', help='Первый месяц, YYYY-MM (по умолчанию весь свод).')
+@click.option('--to', 'to_month', help='Последний месяц включительно, YYYY-MM.')
+def rebuild_rollups_command(from_month, to_month):
+    """Rebuilds the monthly P&L rollup from realization services.
+
+    Without options the whole rollup is rebuilt; --from/--to limit the rebuild
+    to a range of months.
+    """
+    months = None
+    if from_month or to_month:
+        try:
+            start = parse_month(from_month or to_month)
+            end = parse_month(to_month or from_month)
+        except ValueError:
+            raise click.BadParameter('Месяц указывается в формате YYYY-MM.')
+        if start > end:
+            raise click.BadParameter('--from не может быть позже --to.')
+        months = []
+        year, month = start
+        while (year, month) <= end:
+            months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    started = datetime.now()
+    rows = reports.refresh_pnl_rollup(months)
+    db.session.commit()
+    print(f"Строк свода: {rows}. Время: {(datetime.now() - started).total_seconds():.1f} с.")
+
+@app.cli.command('slow-queries')
+@click.option('--top', default=20, show_default=True, help='Сколько запросов показать.')
+@click.option('--plans/--no-plans', default=True, help='Печатать план самого медленного выполнения.')
+def slow_queries_command(top, plans):
+    """Summarizes the slow-query log by normalized statement.
+
+    Reads SLOW_QUERY_LOG with its rotated files and prints the statements with
+    the largest total time: executions, total/max/average time, issuing routes
+    and form_type values, and the plan captured for the slowest execution.
+    """
+    path = app.config['SLOW_QUERY_LOG']
+    groups = slow_queries.summarize(slow_queries.read_log(path, app.config['SLOW_QUERY_LOG_BACKUPS']))
+    if not groups:
+        print(f'Журнал медленных запросов пуст: {path}')
+        return
+    print(f'Запросов в журнале: {sum(group["count"] for group in groups)}, разных: {len(groups)}.')
+    for number, group in enumerate(groups[:top], 1):
+        print(f"\n{number:>2}. {group['count']} раз, всего {group['total_ms']:.1f} мс, "
+              f"макс. {group['max_ms']:.1f} мс, сред. {group['total_ms'] / group['count']:.1f} мс")
+        print(f"    {group['sql'][:500]}")
+        for route, count in sorted(group['routes'].items(), key=lambda item: item[1], reverse=True):
+            print(f'    {count:>5} × {route}')
+        if plans:
+            slowest = group['slowest']
+            print(f"    план ({slowest['at']}, параметры {json.dumps(slowest['parameters'], ensure_ascii=False)[:200]}):")
+            for line in slowest['plan'] or ['—']:
+                print(f'      {line}')
+
+@app.cli.command('seed-synthetic')
+@click.option('--counterparties', default=50, show_default=True, help='Количество контрагентов.')
+@click.option('--contracts', default=100, show_default=True, help='Количество договоров.')
+@click.option('--months', default=12, show_default=True, help='Месяцев реализаций (до текущего включительно).')
+@click.option('--seed', type=int, help='Зерно генератора для воспроизводимого набора.')
+def seed_synthetic_command(counterparties, contracts, months, seed):
+    """Fills the database with a synthetic dataset for load testing.
+
+    Creates counterparties, contracts with specifications and monthly services,
+    realizations for the last MONTHS months and payments with partial
+    allocations, all through bulk inserts. Run flask init-db first.
+    """
+    started = datetime.now()
+    created = benchmarks.seed_synthetic(counterparties, contracts, months, seed)
+    print(', '.join(f'{name}: {count}' for name, count in created.items()))
+    print(f"Время: {(datetime.now() - started).total_seconds():.1f} с.")
+
+BENCHMARK_MARKER = 'BENCHMARK_RESULT '
+
+def parse_benchmark_size(value):
+    """Размер набора NxMxK — контрагенты x договоры x месяцы."""
+    counterparties, contracts, months = (int(part) for part in value.lower().split('x'))
+    return counterparties, contracts, months
+
+@app.cli.command('benchmark-size', hidden=True)
+@click.argument('size')
+@click.option('--repeat', default=3)
+def benchmark_size_command(size, repeat):
+    """Measures routes on a fresh database of one size (run by flask benchmark)."""
+    counterparties, contracts, months = parse_benchmark_size(size)
+    db.create_all()
+    click.get_current_context().invoke(init_db_command)
+    benchmarks.seed_synthetic(counterparties, contracts, months, seed=1)
+
+    contract_id = db.session.scalar(select(func.min(Contract.id)))
+    counterparty_id = db.session.scalar(select(func.min(Counterparty.id)))
+    today = date.today()
+
+    def next_month(attempt):
+        # Каждый повтор формирует новый месяц после синтетического периода
+        year, month = divmod(today.year * 12 + today.month + attempt, 12)
+        return {'month': f'{year}-{month + 1:02}'}
+
+    routes = [
+        ('realizations', 'GET', '/realizations', None),
+        ('realizations_grouped', 'GET', '/realizations?view=grouped', None),
+        ('realizations_counterparty', 'GET', f'/realizations?counterparty_id={counterparty_id}', None),
+        ('payments', 'GET', '/payments', None),
+        ('contracts', 'GET', '/contracts', None),
+        ('contract_detail', 'GET', f'/contract/{contract_id}', None),
+        ('generate_realizations', 'POST', '/generate-realizations', next_month),
+    ]
+    results = benchmarks.measure_routes(app.test_client(), routes, repeat)
+    print(BENCHMARK_MARKER + json.dumps(results))
+
+@app.cli.command('benchmark')
+@click.option('--sizes', default='20x40x6,100x200x12', show_default=True,
+              help='Размеры наборов через запятую: контрагенты x договоры x месяцы.')
+@click.option('--repeat', default=3, show_default=True, help='Повторов каждого маршрута.')
+@click.option('--baseline', 'baseline_path', default=os.path.join(basedir, 'benchmark_baseline.json'),
+              show_default=True, type=click.Path(dir_okay=False), help='JSON-эталон.')
+@click.option('--threshold', default=1.5, show_default=True, help='Допустимый рост времени и памяти, раз.')
+@click.option('--update-baseline', is_flag=True, help='Записать результат как новый эталон.')
+def benchmark_command(sizes, repeat, baseline_path, threshold, update_baseline):
+    """Benchmarks the main routes on synthetic datasets of several sizes.
+
+    Every size runs in a separate process on a temporary SQLite database filled
+    by seed-synthetic; each route records wall time, SQL query count and peak
+    Python memory. Results are compared with the JSON baseline and the command
+    fails on regressions or when the baseline file is missing; --update-baseline
+    writes the results as the new baseline instead.
+    """
+    try:
+        sizes = [size.strip() for size in sizes.split(',') if size.strip()]
+        for size in sizes:
+            parse_benchmark_size(size)
+    except ValueError:
+        raise click.BadParameter('Размер указывается как NxMxK, например 20x40x6.')
+    if not update_baseline and not os.path.exists(baseline_path):
+        raise click.ClickException(
+            f'Нет эталона {baseline_path}: запишите его запуском с --update-baseline.')
+
+    results = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(workdir, 'benchmark.db'))
+            process = subprocess.run(
+                [sys.executable, '-m', 'flask', '--app', 'app', 'benchmark-size', size, '--repeat', str(repeat)],
+                cwd=basedir, env=env, capture_output=True, text=True)
+        lines = [line for line in process.stdout.splitlines() if line.startswith(BENCHMARK_MARKER)]
+        if process.returncode or not lines:
+            raise click.ClickException(f'Замер {size} не выполнен:\n{process.stderr or process.stdout}')
+        results[size] = json.loads(lines[-1][len(BENCHMARK_MARKER):])
+        for route, metrics in results[size].items():
+            print(f"{size:>16} {route:<28} {metrics['wall_ms']:>9.1f} мс {metrics['queries']:>5} запр. "
+                  f"{metrics['peak_kb']:>8} КБ")
+
+    if update_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f'Эталон записан: {baseline_path}')
+        return
+
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = benchmarks.compare_with_baseline(results, baseline, threshold)
+    if regressions:
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        raise click.ClickException(f'Регрессий: {len(regressions)}.')
+    print('Регрессий относительно эталона нет.')
 
 @app.route('/')
 def hello_world():
@@ -113,12 +481,38 @@ def counterparties_list():
 
         return redirect(url_for('counterparties_list'))
 
-    all_counterparties = Counterparty.query.order_by(Counterparty.brand_name).all()
-    return render_template('counterparties.html', counterparties=all_counterparties, types=types)
+    filters = parse_list_filters()
+    # Договоры нужны шаблону для запрета удаления — подгружаем их для всей страницы одним запросом
+    query = Counterparty.query.options(selectinload(Counterparty.contracts))
+    if 'q' in filters:
+        pattern = f"%{filters['q']}%"
+        query = query.filter(or_(Counterparty.brand_name.ilike(pattern), Counterparty.full_name.ilike(pattern)))
+    counterparties, next_cursor = keyset_paginate(
+        query, [Counterparty.brand_name, Counterparty.id], request.args.get('cursor'))
+    return render_template('counterparties.html',
+                           counterparties=counterparties,
+                           types=types,
+                           filters=filters,
+                           next_cursor=next_cursor)
+
+def property_object_usage(object_ids=None):
+    """Количество услуг спецификаций и реализаций по каждому объекту — одним сгруппированным запросом."""
+    spec_refs = select(SpecificationService.property_object_id.label('object_id'))
+    realization_refs = select(RealizationService.property_object_id.label('object_id'))
+    if object_ids is not None:
+        spec_refs = spec_refs.where(SpecificationService.property_object_id.in_(object_ids))
+        realization_refs = realization_refs.where(RealizationService.property_object_id.in_(object_ids))
+    refs = union_all(spec_refs, realization_refs).subquery()
+    rows = db.session.execute(
+        select(refs.c.object_id, func.count())
+        .where(refs.c.object_id.isnot(None))
+        .group_by(refs.c.object_id)
+    )
+    return dict(rows.all())
 
 @app.route('/property-objects', methods=['GET', 'POST'])
 def property_objects_list():
-    object_types = PropertyObjectType.query.order_by(PropertyObjectType.name).all()
+    object_types = get_dictionary('object_types')
 
     if request.method == 'POST':
         form_type = request.form.get('form_type', 'create')
@@ -148,10 +542,7 @@ def property_objects_list():
             object_id = int(request.form.get('object_id'))
             obj = PropertyObject.query.get_or_404(object_id)
 
-            spec_usage = SpecificationService.query.filter_by(property_object_id=obj.id).count()
-            realization_usage = RealizationService.query.filter_by(property_object_id=obj.id).count()
-
-            if spec_usage or realization_usage:
+            if property_object_usage([obj.id]).get(obj.id):
                 flash('Нельзя удалить объект: он используется в спецификациях или реализациях.', 'danger')
             else:
                 db.session.delete(obj)
@@ -161,21 +552,68 @@ def property_objects_list():
         return redirect(url_for('property_objects_list'))
     
     all_objects = PropertyObject.query.order_by(PropertyObject.name).all()
-    usage_map = {
-        obj.id: SpecificationService.query.filter_by(property_object_id=obj.id).count() +
-                 RealizationService.query.filter_by(property_object_id=obj.id).count()
-        for obj in all_objects
-    }
+    usage = property_object_usage()
+    usage_map = {obj.id: usage.get(obj.id, 0) for obj in all_objects}
     return render_template('property_objects.html', 
                            objects=all_objects, 
                            object_types=object_types,
                            usage_map=usage_map)
 
+@app.route('/property-objects/availability')
+def property_objects_availability():
+    """Свободные и занятые объекты за период (по умолчанию — текущий месяц)"""
+    today = date.today()
+    try:
+        start = parse_date(request.args.get('date_from')) or today.replace(day=1)
+        end = parse_date(request.args.get('date_to')) or (
+            date(today.year + today.month // 12, today.month % 12 + 1, 1) - timedelta(days=1))
+    except ValueError:
+        abort(400)
+    if start > end:
+        start, end = end, start
+    only_free = request.args.get('free') == '1'
+    objects = [(item, bookings) for item, bookings in occupancy.availability(start, end)
+               if not (only_free and bookings)]
+    return render_template('property_objects_availability.html',
+                           objects=objects, date_from=start, date_to=end, only_free=only_free)
+
+def contracts_list_query(filters):
+    """Строки списка договоров: колонки договора, имена связанных сущностей и счётчики без загрузки ORM-объектов"""
+    specifications_count = (select(func.count(Specification.id))
+                            .where(Specification.contract_id == Contract.id)
+                            .scalar_subquery())
+    realizations_count = (select(func.count(Realization.id))
+                          .where(Realization.contract_id == Contract.id)
+                          .scalar_subquery())
+    query = (
+        db.session.query(
+            Contract.id, Contract.number, Contract.date, Contract.app_end_date, Contract.pavilion_number,
+            Contract.status, Contract.counterparty_id, Contract.manager_id, Contract.category_id,
+            Counterparty.brand_name.label('counterparty_name'),
+            User.name.label('manager_name'),
+            specifications_count.label('specifications_count'),
+            realizations_count.label('realizations_count'),
+        )
+        .join(Counterparty, Counterparty.id == Contract.counterparty_id)
+        .join(User, User.id == Contract.manager_id)
+    )
+    if 'counterparty_id' in filters:
+        query = query.filter(Contract.counterparty_id == filters['counterparty_id'])
+    if 'manager_id' in filters:
+        query = query.filter(Contract.manager_id == filters['manager_id'])
+    if 'status' in filters:
+        query = query.filter(Contract.status == filters['status'])
+    if 'date_from' in filters:
+        query = query.filter(Contract.date >= filters['date_from'])
+    if 'date_to' in filters:
+        query = query.filter(Contract.date <= filters['date_to'])
+    return query
+
 @app.route('/contracts', methods=['GET', 'POST'])
 def contracts_list():
-    counterparties = Counterparty.query.order_by(Counterparty.brand_name).all()
-    managers = User.query.filter_by(role=Role.MANAGER).order_by(User.name).all()
-    categories = BusinessCategory.query.order_by(BusinessCategory.name).all()
+    counterparties = get_dictionary('counterparties')
+    managers = get_dictionary('managers')
+    categories = get_dictionary('categories')
     statuses = list(ContractStatus)
 
     if request.method == 'POST':
@@ -222,14 +660,9 @@ def contracts_list():
 
         return redirect(url_for('contracts_list'))
 
-    contracts = Contract.query.order_by(Contract.date.desc()).all()
-    usage_map = {
-        contract.id: {
-            'specifications': len(contract.specifications),
-            'realizations': len(contract.realizations)
-        }
-        for contract in contracts
-    }
+    filters = parse_list_filters()
+    contracts, next_cursor = keyset_paginate(
+        contracts_list_query(filters), [Contract.date, Contract.id], request.args.get('cursor'), descending=True)
 
     return render_template('contracts.html', 
                            contracts=contracts,
@@ -237,19 +670,30 @@ def contracts_list():
                            managers=managers,
                            categories=categories,
                            statuses=statuses,
-                           usage_map=usage_map)
+                           filters=filters,
+                           next_cursor=next_cursor)
+
+def occupancy_error(form, start, end, exclude_service_id=None):
+    """Текст ошибки, если объект услуги размещения уже занят в этот период другой услугой."""
+    if not form.get('property_object_id') or not occupancy.is_occupying(int(form['service_type_id'])):
+        return None
+    booking = occupancy.find_conflict(int(form['property_object_id']), start, end, exclude_service_id)
+    if booking is None:
+        return None
+    return (f'Объект уже занят в этот период: договор {booking.contract_number} ({booking.counterparty_name}), '
+            f'{booking.start.strftime("%d/%m/%Y")} - {booking.end.strftime("%d/%m/%Y")}.')
 
 @app.route('/contract/<int:contract_id>', methods=['GET', 'POST'])
 def contract_detail(contract_id):
     contract = Contract.query.get_or_404(contract_id)
     
     # Данные для всех форм, загружаются всегда
-    service_types = ServiceType.query.all()
-    property_objects = PropertyObject.query.all()
+    service_types = get_dictionary('service_types')
+    property_objects = get_dictionary('property_objects')
     billing_types = list(BillingType)
-    counterparties = Counterparty.query.order_by(Counterparty.brand_name).all()
-    managers = User.query.filter_by(role=Role.MANAGER).order_by(User.name).all()
-    categories = BusinessCategory.query.order_by(BusinessCategory.name).all()
+    counterparties = get_dictionary('counterparties')
+    managers = get_dictionary('managers')
+    categories = get_dictionary('categories')
     statuses = list(ContractStatus)
     spec_usage = {
         spec.id: {
@@ -329,6 +773,8 @@ def contract_detail(contract_id):
                 error = f'Дата начала услуги должна быть в пределах спецификации ({spec.start_date.strftime("%d/%m/%Y")} - {spec.end_date.strftime("%d/%m/%Y")}).'
             if service_end and (service_end < spec.start_date or service_end > spec.end_date):
                 error = f'Дата окончания услуги должна быть в пределах спецификации ({spec.start_date.strftime("%d/%m/%Y")} - {spec.end_date.strftime("%d/%m/%Y")}).'
+            if not error:
+                error = occupancy_error(request.form, service_start, service_end or spec.end_date)
 
             if error:
                 flash(error, 'danger')
@@ -360,6 +806,8 @@ def contract_detail(contract_id):
                 error = f'Дата начала услуги должна быть в пределах спецификации ({spec.start_date.strftime("%d/%m/%Y")} - {spec.end_date.strftime("%d/%m/%Y")}).'
             if service_end and (service_end < spec.start_date or service_end > spec.end_date):
                 error = f'Дата окончания услуги должна быть в пределах спецификации ({spec.start_date.strftime("%d/%m/%Y")} - {spec.end_date.strftime("%d/%m/%Y")}).'
+            if not error:
+                error = occupancy_error(request.form, service_start, service_end or spec.end_date, service.id)
 
             if error:
                 flash(error, 'danger')
@@ -575,18 +1023,7 @@ def realizations_list():
                     expense_amount = Decimal('0')
 
             if has_error or not all([realization_date, counterparty_id, manager, service_type, sale_amount]):
-                return render_template(
-                    'realizations.html',
-                    realizations=Realization.query.order_by(Realization.date.desc()).all(),
-                    counterparties=Counterparty.query.order_by(Counterparty.brand_name).all(),
-                    contracts=Contract.query.order_by(Contract.number).all(),
-                    specifications=Specification.query.order_by(Specification.number).all(),
-                    managers=User.query.filter_by(role=Role.MANAGER).order_by(User.name).all(),
-                    service_types=ServiceType.query.order_by(ServiceType.name).all(),
-                    property_objects=PropertyObject.query.order_by(PropertyObject.name).all(),
-                    now=datetime.now(),
-                    one_off_form_data=one_off_form_data
-                )
+                return render_realizations_list(one_off_form_data)
 
             realization = Realization(
                 date=realization_date,
@@ -615,13 +1052,71 @@ def realizations_list():
             flash('Разовая реализация создана.', 'success')
             return redirect(url_for('realizations_list'))
 
-    realizations = Realization.query.order_by(Realization.date.desc()).all()
-    counterparties = Counterparty.query.order_by(Counterparty.brand_name).all()
-    contracts = Contract.query.order_by(Contract.number).all()
-    specifications = Specification.query.order_by(Specification.number).all()
-    managers = User.query.filter_by(role=Role.MANAGER).order_by(User.name).all()
-    service_types = ServiceType.query.order_by(ServiceType.name).all()
-    property_objects = PropertyObject.query.order_by(PropertyObject.name).all()
+    return render_realizations_list(one_off_form_data)
+
+def filter_realizations(query, filters):
+    """Фильтры списка реализаций; подходит и для Query, и для select()"""
+    if 'counterparty_id' in filters:
+        query = query.filter(Realization.counterparty_id == filters['counterparty_id'])
+    if 'manager_id' in filters:
+        query = query.filter(Realization.manager_id == filters['manager_id'])
+    if 'payment_status' in filters:
+        query = query.filter(Realization.payment_status == filters['payment_status'])
+    if 'date_from' in filters:
+        query = query.filter(Realization.date >= filters['date_from'])
+    if 'date_to' in filters:
+        query = query.filter(Realization.date <= filters['date_to'])
+    return query
+
+def realizations_list_query(filters):
+    """Реализации с фильтрами и связями, которые выводятся в строке списка"""
+    query = Realization.query.options(
+        joinedload(Realization.counterparty),
+        joinedload(Realization.contract),
+        joinedload(Realization.specification),
+        joinedload(Realization.manager),
+        selectinload(Realization.services).joinedload(RealizationService.service_type),
+        selectinload(Realization.services).joinedload(RealizationService.property_object),
+    )
+    return filter_realizations(query, filters)
+
+def realization_totals_columns():
+    """Агрегаты ведомости реализаций: количество, суммы продаж/расходов/прибыли, оплачено и долг"""
+    return [
+        func.count(Realization.id).label('realizations_count'),
+        func.coalesce(func.sum(case((Realization.payment_status != PaymentStatus.PAID, 1), else_=0)), 0).label('unpaid_count'),
+        func.coalesce(func.sum(Realization.total_sale), 0).label('total_sale'),
+        func.coalesce(func.sum(Realization.total_expense), 0).label('total_expense'),
+        func.coalesce(func.sum(Realization.total_profit), 0).label('total_profit'),
+        func.coalesce(func.sum(Realization.paid_amount), 0).label('paid_amount'),
+        func.coalesce(func.sum(Realization.debt_amount), 0).label('debt_amount'),
+    ]
+
+def render_realizations_list(one_off_form_data=None):
+    filters = parse_list_filters()
+    grouped = request.args.get('view') == 'grouped'
+    realizations = groups = totals = None
+    if grouped:
+        # Ведомость по контрагентам: итоги групп и общий итог считает БД, строки групп не загружаются
+        groups_query = filter_realizations(
+            db.session.query(Counterparty.id, Counterparty.brand_name, *realization_totals_columns())
+            .join(Realization, Realization.counterparty_id == Counterparty.id),
+            filters,
+        ).group_by(Counterparty.id, Counterparty.brand_name)
+        groups, next_cursor = keyset_paginate(
+            groups_query, [Counterparty.brand_name, Counterparty.id], request.args.get('cursor'))
+        totals = filter_realizations(db.session.query(*realization_totals_columns()), filters).one()
+    else:
+        realizations, next_cursor = keyset_paginate(
+            realizations_list_query(filters), [Realization.date, Realization.id],
+            request.args.get('cursor'), descending=True)
+
+    counterparties = get_dictionary('counterparties')
+    contracts = get_dictionary('contracts')
+    specifications = get_dictionary('specifications')
+    managers = get_dictionary('managers')
+    service_types = get_dictionary('service_types')
+    property_objects = get_dictionary('property_objects')
 
     return render_template('realizations.html', 
                           realizations=realizations, 
@@ -631,9 +1126,189 @@ def realizations_list():
                           managers=managers,
                           service_types=service_types,
                           property_objects=property_objects,
+                          payment_statuses=list(PaymentStatus),
+                          filters=filters,
+                          grouped=grouped,
+                          groups=groups,
+                          totals=totals,
+                          next_cursor=next_cursor,
                           now=datetime.now(),
                           one_off_form_data=one_off_form_data)
 
+@app.route('/realizations/group/<int:counterparty_id>')
+def realization_group_rows(counterparty_id):
+    """Строки одной группы ведомости по контрагентам (HTML-фрагмент для раскрытия группы)"""
+    filters = parse_list_filters()
+    filters['counterparty_id'] = counterparty_id
+    realizations, next_cursor = keyset_paginate(
+        realizations_list_query(filters), [Realization.date, Realization.id],
+        request.args.get('cursor'), descending=True)
+    return render_template('_realization_group_rows.html', realizations=realizations, next_cursor=next_cursor)
+
+EXPORT_HEADER = ['Номер', 'Дата', 'Контрагент', 'Договор', 'Спецификация',
+                 'Продажа', 'Расход', 'Прибыль', 'Статус оплаты']
+EXPORT_FORMATS = {
+    'xlsx': (stream_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+}
+
+@app.route('/realizations/export')
+def export_realizations():
+    """Выгрузка реестра реализаций с фильтрами списка; файл отдаётся потоком"""
+    export_format = request.args.get('format', 'xlsx')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    writer, mimetype = EXPORT_FORMATS[export_format]
+
+    stmt = filter_realizations(
+        select(Realization.number, Realization.date, Counterparty.brand_name, Contract.number,
+               Specification.number, Realization.total_sale, Realization.total_expense,
+               Realization.payment_status)
+        .join(Counterparty, Counterparty.id == Realization.counterparty_id)
+        .outerjoin(Contract, Contract.id == Realization.contract_id)
+        .outerjoin(Specification, Specification.id == Realization.specification_id),
+        parse_list_filters(),
+    ).order_by(Realization.date, Realization.id)
+
+    def rows():
+        # yield_per включает серверный курсор: строки читаются порциями, а не списком целиком
+        result = db.session.execute(stmt.execution_options(yield_per=1000))
+        for number, realization_date, counterparty, contract, specification, sale, expense, status in result:
+            yield (number, realization_date, counterparty, contract, specification,
+                   sale, expense, sale - expense, status.value)
+
+    filename = f'realizations_{datetime.now():%Y%m%d_%H%M}.{export_format}'
+    return Response(stream_with_context(writer(EXPORT_HEADER, rows())), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/realizations/<int:realization_id>/data')
+def realization_data(realization_id):
+    """Данные одной реализации для общей модалки редактирования"""
+    realization = Realization.query.options(
+        joinedload(Realization.counterparty),
+        joinedload(Realization.contract),
+        joinedload(Realization.specification),
+        joinedload(Realization.manager),
+        selectinload(Realization.services).joinedload(RealizationService.service_type),
+        selectinload(Realization.services).joinedload(RealizationService.property_object),
+    ).filter(Realization.id == realization_id).first_or_404()
+    service = realization.services[0] if realization.services else None
+
+    return jsonify({
+        'id': realization.id,
+        'number': realization.number,
+        'date': realization.date.strftime('%d/%m/%Y'),
+        'source': realization.source.name,
+        'payment_status': realization.payment_status.value,
+        'counterparty_id': realization.counterparty_id,
+        'counterparty_name': realization.counterparty.brand_name,
+        'manager_id': realization.manager_id,
+        'manager_name': realization.manager.name,
+        'contract_id': realization.contract_id,
+        'contract_number': realization.contract.number if realization.contract else None,
+        'specification_id': realization.specification_id,
+        'specification_number': realization.specification.number if realization.specification else None,
+        'service_type_id': service.service_type_id if service else None,
+        'service_type_name': service.service_type.name.value if service else None,
+        'property_object_id': service.property_object_id if service else None,
+        'property_object_name': service.property_object.name if service and service.property_object else None,
+        'description': service.description if service else '',
+        'sale_amount': f'{service.sale_amount:.2f}' if service else '0.00',
+        'expense_amount': f'{service.expense_amount or 0:.2f}' if service else '0.00',
+    })
+
+def month_candidates_query(year, month):
+    """Ежемесячные услуги активных договоров, по которым за месяц ещё нет реализации.
+
+    Проверка наличия — anti-join по уникальному индексу (specification_service_id, year, month).
+    """
+    month_start = date(year, month, 1)
+    month_end = date(year + (month // 12), (month % 12) + 1, 1) - timedelta(days=1)
+    return (
+        select(
+            Contract.id.label('contract_id'),
+            Contract.counterparty_id,
+            Contract.manager_id,
+            Specification.id.label('specification_id'),
+            SpecificationService.id.label('specification_service_id'),
+            SpecificationService.description,
+            SpecificationService.amount,
+            SpecificationService.property_object_id,
+            SpecificationService.service_type_id,
+        )
+        .join(Specification, Specification.contract_id == Contract.id)
+        .join(SpecificationService, SpecificationService.specification_id == Specification.id)
+        .outerjoin(Realization, and_(
+            Realization.specification_service_id == SpecificationService.id,
+            Realization.year == year,
+            Realization.month == month,
+        ))
+        .where(
+            Contract.status == ContractStatus.ACTIVE,
+            Specification.start_date <= month_end,
+            Specification.end_date >= month_start,
+            SpecificationService.billing_type == BillingType.MONTHLY,
+            Realization.id.is_(None),
+        )
+        .order_by(Contract.id, Specification.id, SpecificationService.id)
+    )
+
+def generate_month_realizations(year, month, contract_ids=None):
+    """Формирует AUTO-реализации за месяц фиксированным числом запросов.
+
+    contract_ids ограничивает генерацию частью договоров (пакетная обработка из CLI).
+    Возвращает количество созданных реализаций; commit выполняет вызывающий код.
+    """
+    month_start = date(year, month, 1)
+
+    # 1. Ежемесячные услуги активных договоров, по которым за месяц ещё нет реализации
+    query = month_candidates_query(year, month)
+    if contract_ids is not None:
+        query = query.where(Contract.id.in_(contract_ids))
+    pending = db.session.execute(query).all()
+    if not pending:
+        return 0
+
+    # 2. Пакетная вставка реализаций и их услуг
+    stamp = datetime.now().timestamp()
+    numbered = {f'{stamp:.6f}-{index}': row for index, row in enumerate(pending)}
+    inserted = db.session.execute(
+        insert(Realization).returning(Realization.id, Realization.number),
+        [
+            {
+                'number': number,
+                'date': month_start,
+                'source': RealizationSource.AUTO,
+                'month': month,
+                'year': year,
+                'payment_status': PaymentStatus.NOT_PAID,
+                'paid_amount': Decimal('0'),
+                'total_sale': row.amount,
+                'total_expense': Decimal('0'),
+                'counterparty_id': row.counterparty_id,
+                'contract_id': row.contract_id,
+                'specification_id': row.specification_id,
+                'specification_service_id': row.specification_service_id,
+                'manager_id': row.manager_id,
+            }
+            for number, row in numbered.items()
+        ],
+    ).all()
+
+    db.session.execute(RealizationService.__table__.insert(), [
+        {
+            'realization_id': realization_id,
+            'description': numbered[number].description,
+            'sale_amount': numbered[number].amount,
+            'expense_amount': Decimal('0'),
+            'property_object_id': numbered[number].property_object_id,
+            'service_type_id': numbered[number].service_type_id,
+        }
+        for realization_id, number in inserted
+    ])
+    reports.mark_pnl_months(db.session, [(year, month)])
+    return len(pending)
+
 @app.route('/generate-realizations', methods=['POST'])
 def generate_realizations():
     month_year_str = request.form.get('month')
@@ -642,65 +1317,8 @@ def generate_realizations():
         return redirect(url_for('realizations_list'))
 
     year, month = map(int, month_year_str.split('-'))
-    month_start = date(year, month, 1)
-    next_month = date(year + (month // 12), (month % 12) + 1, 1)
-    month_end = next_month - timedelta(days=1)
-    
-    # 1. Найти все активные договоры
-    active_contracts = Contract.query.filter_by(status=ContractStatus.ACTIVE).all()
-    
-    generated_count = 0
+    generated_count = generate_month_realizations(year, month)
 
-    for contract in active_contracts:
-        # 2. Найти все подходящие спецификации
-        specs = Specification.query.filter(
-            Specification.contract_id == contract.id,
-            Specification.start_date <= month_end,
-            Specification.end_date >= month_start
-        ).all()
-
-        for spec in specs:
-            # 3. Найти все ежемесячные услуги
-            monthly_services = SpecificationService.query.filter_by(
-                specification_id=spec.id,
-                billing_type=BillingType.MONTHLY
-            ).all()
-
-            for service in monthly_services:
-                 # 4. Проверить, не создана ли уже реализация
-                exists = Realization.query.filter_by(
-                    contract_id=contract.id,
-                    specification_id=spec.id,
-                    month=month,
-                    year=year
-                ).join(RealizationService).filter(RealizationService.description == service.description).count() > 0
-
-                if not exists:
-                    # 5. Создать реализацию
-                    new_realization = Realization(
-                        date=month_start,
-                        source=RealizationSource.AUTO,
-                        month=month,
-                        year=year,
-                        payment_status=PaymentStatus.NOT_PAID,
-                        counterparty_id=contract.counterparty_id,
-                        contract_id=contract.id,
-                        specification_id=spec.id,
-                        manager_id=contract.manager_id,
-                    )
-                    
-                    realization_service = RealizationService(
-                        description=service.description,
-                        sale_amount=service.amount,
-                        property_object_id=service.property_object_id,
-                        service_type_id=service.service_type_id,
-                        realization=new_realization
-                    )
-                    
-                    db.session.add(new_realization)
-                    db.session.add(realization_service)
-                    generated_count += 1
-    
     if generated_count > 0:
         db.session.commit()
         flash(f'Успешно сгенерировано {generated_count} новых реализаций за {month:02}.{year}.', 'success')
@@ -710,6 +1328,139 @@ def generate_realizations():
     return redirect(url_for('realizations_list'))
 
 
+def outstanding_realizations_query():
+    """Реализации с положительным остатком долга, от старых к новым, с номерами договора и спецификации."""
+    debt = Realization.debt_amount
+    return (
+        select(
+            Realization.id,
+            Realization.number,
+            Realization.date,
+            Realization.counterparty_id,
+            Realization.total_sale,
+            Realization.paid_amount,
+            debt.label('debt'),
+            Contract.number.label('contract_number'),
+            Specification.number.label('specification_number'),
+        )
+        .outerjoin(Contract, Contract.id == Realization.contract_id)
+        .outerjoin(Specification, Specification.id == Realization.specification_id)
+        # То же, что debt > 0; порядок — по ix_realization_counterparty_date
+        .where(Realization.total_sale > Realization.paid_amount)
+        .order_by(Realization.counterparty_id, Realization.date, Realization.id)
+    )
+
+def apply_allocations(allocations, new_payment=False):
+    """Записывает разнесения (payment_id, realization_id, сумма) пакетно.
+
+    Связи вставляются одним executemany (существующие пары дополняются; для только что
+    созданного платежа их нет и проверка пропускается), оплаченные суммы реализаций
+    увеличиваются executemany-UPDATE, статусы пересчитываются одним UPDATE.
+    Остаток платежей не трогает. Возвращает общую разнесённую сумму.
+    """
+    association = payment_realization_association
+    existing = set()
+    if not new_payment:
+        payment_ids = {payment_id for payment_id, _, _ in allocations}
+        existing = set(db.session.execute(
+            select(association.c.payment_id, association.c.realization_id)
+            .where(association.c.payment_id.in_(payment_ids))).all())
+    new_rows, extra_rows = [], []
+    realization_totals = {}
+    for payment_id, realization_id, amount in allocations:
+        if (payment_id, realization_id) in existing:
+            extra_rows.append({'p_id': payment_id, 'r_id': realization_id, 'delta': amount})
+        else:
+            new_rows.append({'payment_id': payment_id, 'realization_id': realization_id, 'amount': amount})
+        realization_totals[realization_id] = realization_totals.get(realization_id, Decimal('0')) + amount
+    if new_rows:
+        db.session.execute(association.insert(), new_rows)
+    if extra_rows:
+        db.session.execute(
+            association.update()
+            .where(association.c.payment_id == bindparam('p_id'), association.c.realization_id == bindparam('r_id'))
+            .values(amount=association.c.amount + bindparam('delta')),
+            extra_rows)
+
+    realization_table = Realization.__table__
+    db.session.execute(
+        realization_table.update().where(realization_table.c.id == bindparam('r_id'))
+        .values(paid_amount=realization_table.c.paid_amount + bindparam('delta')),
+        [{'r_id': id, 'delta': amount} for id, amount in realization_totals.items()])
+    db.session.execute(
+        update(Realization).where(Realization.id.in_(list(realization_totals)))
+        .values(payment_status=Realization.payment_status_expression())
+        .execution_options(synchronize_session=False))
+    # Core-запросы мимо identity map: загруженные в сессию объекты должны перечитаться
+    db.session.expire_all()
+    return sum(realization_totals.values(), Decimal('0'))
+
+def open_advances_query(counterparty_id=None):
+    """Платежи с нераспределённым остатком, от старых к новым по каждому контрагенту."""
+    query = (
+        select(Payment.id, Payment.counterparty_id, Payment.unallocated_amount)
+        .where(Payment.unallocated_amount > 0)
+        .order_by(Payment.counterparty_id, Payment.date, Payment.id)
+    )
+    if counterparty_id is not None:
+        query = query.where(Payment.counterparty_id == counterparty_id)
+    return query
+
+def allocate_advances(counterparty_id=None):
+    """Зачёт авансов (нераспределённых остатков платежей) на неоплаченные реализации по FIFO.
+
+    Для каждого контрагента самые старые авансы гасят самые старые долги. Все суммы
+    читаются двумя запросами, разнесение считается в памяти, запись — пакетными
+    UPDATE/INSERT (см. apply_allocations). Возвращает (число разнесений, зачтённая сумма);
+    commit делает вызывающий.
+    """
+    advances = {}
+    for row in db.session.execute(open_advances_query(counterparty_id)):
+        advances.setdefault(row.counterparty_id, []).append([row.id, Decimal(str(row.unallocated_amount))])
+    if not advances:
+        return 0, Decimal('0')
+
+    allocations = []  # (payment_id, realization_id, сумма)
+    current_counterparty = queue = None
+    debts = db.session.execute(
+        outstanding_realizations_query().where(Realization.counterparty_id.in_(list(advances))))
+    for row in debts:
+        if row.counterparty_id != current_counterparty:
+            current_counterparty, queue = row.counterparty_id, advances[row.counterparty_id]
+        debt = Decimal(str(row.debt))
+        while debt > 0 and queue:
+            payment = queue[0]
+            amount = min(debt, payment[1])
+            allocations.append((payment[0], row.id, amount))
+            payment[1] -= amount
+            debt -= amount
+            if payment[1] == 0:
+                queue.pop(0)
+    if not allocations:
+        return 0, Decimal('0')
+
+    payment_totals = {}
+    for payment_id, _, amount in allocations:
+        payment_totals[payment_id] = payment_totals.get(payment_id, Decimal('0')) + amount
+    payment_table = Payment.__table__
+    db.session.execute(
+        payment_table.update().where(payment_table.c.id == bindparam('p_id'))
+        .values(unallocated_amount=payment_table.c.unallocated_amount - bindparam('delta')),
+        [{'p_id': id, 'delta': amount} for id, amount in payment_totals.items()])
+    total = apply_allocations(allocations)
+    return len(allocations), total
+
+def payments_list_query(filters):
+    """Платежи с фильтрами списка и связями, которые выводятся в строке"""
+    query = Payment.query.options(joinedload(Payment.counterparty), joinedload(Payment.contract))
+    if 'counterparty_id' in filters:
+        query = query.filter(Payment.counterparty_id == filters['counterparty_id'])
+    if 'date_from' in filters:
+        query = query.filter(Payment.date >= filters['date_from'])
+    if 'date_to' in filters:
+        query = query.filter(Payment.date <= filters['date_to'])
+    return query
+
 @app.route('/payments', methods=['GET', 'POST'])
 def payments_list():
     if request.method == 'POST':
@@ -778,35 +1529,46 @@ def payments_list():
                 flash('Укажите корректную сумму платежа.', 'danger')
                 has_error = True
             
-            selected_realizations_ids = form.getlist('realization_ids')
+            # Выбранные реализации — одним IN-запросом вместе с контрагентом и остатком долга
             selected_realizations = []
-            if selected_realizations_ids:
-                for realization_id_raw in selected_realizations_ids:
-                    try:
-                        realization_id = int(realization_id_raw)
-                        realization = Realization.query.get(realization_id)
-                    except ValueError:
-                        realization = None
-                    if not realization:
-                        flash('Выбрана некорректная реализация.', 'danger')
-                        has_error = True
-                        break
-                    if counterparty_id and realization.counterparty_id != counterparty_id:
-                        flash('Выбранная реализация не принадлежит контрагенту платежа.', 'danger')
-                        has_error = True
-                        break
-                    if realization.debt_amount <= 0:
-                        continue
-                    selected_realizations.append(realization)
+            try:
+                realization_ids = list(dict.fromkeys(int(value) for value in form.getlist('realization_ids')))
+            except ValueError:
+                realization_ids = None
+            if realization_ids:
+                rows = {row.id: row for row in db.session.execute(
+                    select(Realization.id, Realization.counterparty_id, Realization.debt_amount.label('debt'))
+                    .where(Realization.id.in_(realization_ids)))}
+                if len(rows) != len(realization_ids):
+                    realization_ids = None
+                elif counterparty_id and any(row.counterparty_id != counterparty_id for row in rows.values()):
+                    flash('Выбранная реализация не принадлежит контрагенту платежа.', 'danger')
+                    has_error = True
+                else:
+                    selected_realizations = [rows[id] for id in realization_ids if rows[id].debt > 0]
+            if realization_ids is None:
+                flash('Выбрана некорректная реализация.', 'danger')
+                has_error = True
             
             if has_error or not all([payment_date, counterparty_id, payment_type, amount]):
                 return redirect(url_for('payments_list'))
             
+            # Разносим сумму по выбранным реализациям в порядке выбора, остаток становится авансом
+            allocations = []
+            remaining = amount
+            for realization in selected_realizations:
+                if remaining <= 0:
+                    break
+                allocation_amount = min(Decimal(str(realization.debt)), remaining)
+                allocations.append((realization.id, allocation_amount))
+                remaining -= allocation_amount
+            total_allocated = amount - remaining
+
             # Создаем платеж
             payment = Payment(
                 date=payment_date,
                 initial_amount=amount,
-                unallocated_amount=amount,
+                unallocated_amount=remaining,
                 payment_type=payment_type,
                 counterparty_id=counterparty_id,
                 contract_id=contract_id
@@ -814,73 +1576,72 @@ def payments_list():
             
             db.session.add(payment)
             db.session.flush()  # Получаем ID платежа
-            
-            total_allocated = Decimal('0')
-            for realization in selected_realizations:
-                if total_allocated >= amount:
-                    break
-                debt = realization.debt_amount
-                if debt <= 0:
-                    continue
-                allocation_amount = min(debt, amount - total_allocated)
-                if allocation_amount <= 0:
-                    continue
-                db.session.execute(payment_realization_association.insert().values(
-                    payment_id=payment.id,
-                    realization_id=realization.id,
-                    amount=allocation_amount
-                ))
-                realization.paid_amount = Decimal(str(realization.paid_amount)) + allocation_amount
-                realization.update_payment_status()
-                total_allocated += allocation_amount
-            
-            payment.unallocated_amount = max(Decimal('0'), amount - total_allocated)
+            if allocations:
+                apply_allocations([(payment.id, realization_id, allocation_amount)
+                                   for realization_id, allocation_amount in allocations], new_payment=True)
             db.session.commit()
             
             if total_allocated > 0:
-                if payment.unallocated_amount > 0:
-                    flash(f'Платеж создан. На реализации распределено {total_allocated:.2f} руб., аванс {payment.unallocated_amount:.2f} руб.', 'success')
+                if remaining > 0:
+                    flash(f'Платеж создан. На реализации распределено {total_allocated:.2f} руб., аванс {remaining:.2f} руб.', 'success')
                 else:
                     flash('Платеж создан и полностью распределён на выбранные реализации.', 'success')
             else:
                 flash('Платеж создан как аванс. Распределение выполните позже.', 'success')
             return redirect(url_for('payments_list'))
-    
-    payments = Payment.query.order_by(Payment.date.desc()).all()
-    counterparties = Counterparty.query.order_by(Counterparty.brand_name).all()
-    contracts = Contract.query.order_by(Contract.number).all()
-
-    # Список неоплаченных реализаций для каждого контрагента
-    eligible_realizations = Realization.query.filter(Realization.payment_status != PaymentStatus.PAID).order_by(Realization.date.asc()).all()
-    realizations_by_counterparty = {}
-    for realization in eligible_realizations:
-        debt = realization.debt_amount
-        if debt <= 0:
-            continue
-        realizations_by_counterparty.setdefault(realization.counterparty_id, []).append(realization)
 
+        elif form_type == 'allocate_advances':
+            try:
+                counterparty_id = int(request.form['counterparty_id'])
+            except (KeyError, ValueError):
+                counterparty_id = None
+            count, amount = allocate_advances(counterparty_id)
+            db.session.commit()
+            if count:
+                flash(f'Зачтено {amount:.2f} руб. из авансов ({count} разнесений).', 'success')
+            else:
+                flash('Нет авансов для зачёта или неоплаченных реализаций.', 'info')
+            return redirect(url_for('payments_list', counterparty_id=counterparty_id))
+    
+    filters = parse_list_filters()
+    payments, next_cursor = keyset_paginate(
+        payments_list_query(filters), [Payment.date, Payment.id], request.args.get('cursor'), descending=True)
+    counterparties = get_dictionary('counterparties')
+    contracts = get_dictionary('contracts')
+
+    # Число распределений платежей страницы — одним запросом вместо p.realizations.count() в шаблоне
+    allocation_counts = {}
+    if payments:
+        association = payment_realization_association.c
+        allocation_counts = dict(db.session.execute(
+            select(association.payment_id, func.count())
+            .where(association.payment_id.in_([p.id for p in payments]))
+            .group_by(association.payment_id)
+        ).all())
+
+    # Список неоплаченных реализаций для каждого контрагента — одним запросом, долг считается в БД
     realizations_payload = {}
-    for counterparty_id, items in realizations_by_counterparty.items():
-        realizations_payload[str(counterparty_id)] = [
-            {
-                'id': item.id,
-                'number': item.number,
-                'date': item.date.strftime('%d/%m/%Y'),
-                'contract_number': item.contract.number if item.contract else None,
-                'specification_number': item.specification.number if item.specification else None,
-                'total': float(item.total_sale),
-                'paid': float(item.paid_amount or 0),
-                'debt': float(item.debt_amount)
-            }
-            for item in items
-        ]
+    for row in db.session.execute(outstanding_realizations_query()):
+        realizations_payload.setdefault(str(row.counterparty_id), []).append({
+            'id': row.id,
+            'number': row.number,
+            'date': row.date.strftime('%d/%m/%Y'),
+            'contract_number': row.contract_number,
+            'specification_number': row.specification_number,
+            'total': float(row.total_sale),
+            'paid': float(row.paid_amount or 0),
+            'debt': float(row.debt),
+        })
     
     return render_template('payments.html',
                           payments=payments,
+                          allocation_counts=allocation_counts,
                           counterparties=counterparties,
                           contracts=contracts,
                           payment_types=list(PaymentType),
                           realizations_json=realizations_payload,
+                          filters=filters,
+                          next_cursor=next_cursor,
                           now=datetime.now())
 
 @app.route('/update-payment/<int:payment_id>', methods=['POST'])
@@ -945,37 +1706,255 @@ def update_payment(payment_id):
     flash('Платеж обновлён.', 'success')
     return redirect(url_for('payments_list'))
 
+def delete_payments(payment_ids):
+    """Удаляет платежи и откатывает их распределения фиксированным числом запросов.
+
+    Оплаченные суммы реализаций уменьшаются одним UPDATE с коррелированной суммой,
+    статусы пересчитываются вторым UPDATE, затем удаляются связи и сами платежи.
+    Возвращает число удалённых платежей; commit делает вызывающий.
+    """
+    association = payment_realization_association
+    payment_ids = list(payment_ids)
+    affected = select(association.c.realization_id).where(association.c.payment_id.in_(payment_ids))
+    rollback = (
+        select(func.sum(association.c.amount))
+        .where(association.c.payment_id.in_(payment_ids), association.c.realization_id == Realization.id)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        update(Realization).where(Realization.id.in_(affected))
+        .values(paid_amount=Realization.paid_amount - rollback)
+        .execution_options(synchronize_session=False))
+    db.session.execute(
+        update(Realization).where(Realization.id.in_(affected))
+        .values(payment_status=Realization.payment_status_expression())
+        .execution_options(synchronize_session=False))
+    db.session.execute(association.delete().where(association.c.payment_id.in_(payment_ids)))
+    deleted = db.session.execute(
+        Payment.__table__.delete().where(Payment.__table__.c.id.in_(payment_ids))).rowcount
+    # Запросы шли мимо identity map: загруженные в сессию объекты должны перечитаться
+    db.session.expire_all()
+    return deleted
+
 @app.route('/delete-payment/<int:payment_id>', methods=['POST'])
 def delete_payment(payment_id):
-    payment = Payment.query.get_or_404(payment_id)
-    
-    # Проверяем, есть ли привязанные реализации
-    allocated_realizations = db.session.execute(
-        payment_realization_association.select().where(
-            payment_realization_association.c.payment_id == payment_id
-        )
-    ).fetchall()
-    
-    if allocated_realizations:
-        # Откатываем все распределения
-        for row in allocated_realizations:
-            realization = Realization.query.get(row.realization_id)
-            if realization:
-                realization.paid_amount = Decimal(str(realization.paid_amount)) - Decimal(str(row.amount))
-                realization.update_payment_status()
-        
-        # Удаляем записи из таблицы связи
-        db.session.execute(
-            payment_realization_association.delete().where(
-                payment_realization_association.c.payment_id == payment_id
-            )
-        )
-    
-    db.session.delete(payment)
+    if not delete_payments([payment_id]):
+        abort(404)
     db.session.commit()
     flash('Платеж удалён, распределения откатаны.', 'success')
     return redirect(url_for('payments_list'))
 
+@app.route('/delete-payments', methods=['POST'])
+def delete_selected_payments():
+    """Массовое удаление отмеченных в списке платежей"""
+    payment_ids = {int(value) for value in request.form.getlist('payment_ids') if value.isdigit()}
+    if not payment_ids:
+        flash('Не выбрано ни одного платежа.', 'warning')
+        return redirect(url_for('payments_list'))
+    deleted = delete_payments(payment_ids)
+    db.session.commit()
+    flash(f'Удалено платежей: {deleted}, распределения откатаны.', 'success')
+    return redirect(url_for('payments_list'))
+
+# --- Отчёты ---
+
+@app.route('/reports/aging')
+def aging_report():
+    """Дебиторская задолженность по срокам (кэшируется до записи реализаций или платежей)"""
+    return render_template('reports_aging.html', report=reports.get_aging_report(), buckets=reports.AGING_BUCKETS)
+
+@app.route('/reports/aging/export')
+def export_aging_report():
+    """Выгрузка отчёта по срокам в XLSX: по контрагентам (с авансами) или по менеджерам"""
+    by = request.args.get('by', 'counterparty')
+    if by not in ('counterparty', 'manager'):
+        abort(400)
+    report = reports.get_aging_report()
+    bucket_titles = [title for title, _ in reports.AGING_BUCKETS]
+    if by == 'counterparty':
+        header = ['Контрагент', *bucket_titles, 'Итого долг', 'Аванс']
+        rows = [(row.name, *row.buckets, row.total, row.advance) for row in report.by_counterparty]
+        rows.append(('Итого', *report.totals, sum(report.totals), report.advance_total))
+    else:
+        header = ['Менеджер', *bucket_titles, 'Итого долг']
+        rows = [(row.name, *row.buckets, row.total) for row in report.by_manager]
+        rows.append(('Итого', *report.totals, sum(report.totals)))
+
+    filename = f'aging_{by}_{report.as_of:%Y%m%d}.xlsx'
+    return Response(stream_xlsx(header, rows, sheet_name='Дебиторка'),
+                    mimetype=EXPORT_FORMATS['xlsx'][1],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+PNL_GROUPS = {
+    'month': 'Месяц',
+    'manager': 'Менеджер',
+    'category': 'Категория',
+    'service_type': 'Тип услуги',
+    'property_object': 'Объект',
+}
+
+@app.route('/reports/pnl')
+def pnl_report():
+    """P&L по месяцам и измерениям; читает только помесячный свод PnlRollup"""
+    args = request.args
+    group_by = [name for name in PNL_GROUPS if name in args.getlist('group')] or ['month', 'manager']
+    filters = {}
+    for name in ('month_from', 'month_to'):
+        try:
+            filters[name] = parse_month(args[name])
+        except (KeyError, ValueError):
+            pass
+    for name in ('manager_id', 'category_id', 'service_type_id', 'property_object_id'):
+        try:
+            filters[name] = int(args[name])
+        except (KeyError, ValueError):
+            pass
+
+    # Названия измерений берутся из кэша справочников, а не JOIN к своду
+    names = {
+        'manager': {item.id: item.name for item in get_dictionary('managers')},
+        'category': {item.id: item.name.value for item in get_dictionary('categories')},
+        'service_type': {item.id: item.name.value for item in get_dictionary('service_types')},
+        'property_object': {item.id: item.name for item in get_dictionary('property_objects')},
+    }
+    rows = []
+    for row in reports.build_pnl_report(group_by, filters):
+        values = list(row)
+        labels = []
+        for name in group_by:
+            if name == 'month':
+                year, month = values.pop(0), values.pop(0)
+                labels.append(f'{int(month):02}.{int(year)}')
+            else:
+                key = values.pop(0)
+                labels.append(names[name].get(key, '—') if key is not None else '—')
+        sale, expense, services_count = values
+        rows.append((labels, sale or 0, expense or 0, services_count or 0))
+
+    totals = (sum((row[1] for row in rows), Decimal('0')), sum((row[2] for row in rows), Decimal('0')))
+    return render_template('reports_pnl.html', rows=rows, totals=totals, group_by=group_by,
+                           groups=PNL_GROUPS, filters=filters, names=names,
+                           month_value=lambda value: f'{value[0]:04}-{value[1]:02}' if value else '')
+
+# --- JSON API (только чтение) ---
+
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 500
+
+def api_error(message, status=400):
+    return Response(api.dumps({'error': message}), status=status, mimetype='application/json')
+
+def api_list(query, spec, sort_column, related=None):
+    """Страница ресурса API по возрастанию sort_column.
+
+    ?fields — набор полей, ?limit — размер страницы, ?cursor — курсор из next_cursor
+    предыдущей страницы. related — {поле: функция(строки страницы) -> {id: значение}}
+    для данных, загружаемых одним дополнительным запросом и только если поле запрошено.
+    ETag считается до запроса страницы по версиям таблиц в БД (api.etag); при совпадении
+    с If-None-Match сразу отдаётся 304 без тела.
+    """
+    args = request.args
+    try:
+        fields = api.select_fields(spec, args.get('fields'))
+    except ValueError as exc:
+        return api_error(str(exc))
+    try:
+        limit = int(args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        limit = None
+    if limit is None or not 1 <= limit <= API_MAX_PAGE_SIZE:
+        return api_error(f'limit должен быть целым числом от 1 до {API_MAX_PAGE_SIZE}.')
+    cursor = args.get('cursor')
+    if cursor and decode_cursor(cursor, [sort_column]) is None:
+        return api_error('Некорректный курсор.')
+
+    etag = api.etag(request.endpoint, args)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        items, next_cursor = keyset_paginate(query, [sort_column], cursor, page_size=limit)
+        values = {name: load(items) for name, load in (related or {}).items() if name in fields and items}
+        data = [
+            api.serialize(item, spec, fields, **{name: by_id.get(item.id, []) for name, by_id in values.items()})
+            for item in items
+        ]
+        response = Response(api.dumps({'data': data, 'next_cursor': next_cursor}), mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def payment_allocations(payments):
+    """Распределения платежей страницы одним запросом: {id платежа: [{realization_id, realization_number, amount}]}"""
+    association = payment_realization_association.c
+    rows = db.session.execute(
+        select(association.payment_id, association.realization_id, Realization.number, association.amount)
+        .join(Realization, Realization.id == association.realization_id)
+        .where(association.payment_id.in_([p.id for p in payments]))
+        .order_by(association.payment_id, association.realization_id)
+    )
+    allocations = {}
+    for payment_id, realization_id, number, amount in rows:
+        allocations.setdefault(payment_id, []).append(
+            {'realization_id': realization_id, 'realization_number': number, 'amount': api.to_json(amount)})
+    return allocations
+
+@app.route('/api/v1/')
+def api_index():
+    """Список ресурсов API и их полей"""
+    resources = {
+        'counterparties': api.COUNTERPARTY_FIELDS,
+        'contracts': api.CONTRACT_FIELDS,
+        'specifications': api.SPECIFICATION_FIELDS,
+        'realizations': api.REALIZATION_FIELDS,
+        'payments': api.PAYMENT_FIELDS,
+    }
+    return Response(api.dumps({name: {'url': url_for(f'api_{name}'), 'fields': list(spec)}
+                               for name, spec in resources.items()}), mimetype='application/json')
+
+@app.route('/api/v1/counterparties')
+def api_counterparties():
+    filters = parse_list_filters()
+    query = Counterparty.query
+    if 'q' in filters:
+        pattern = f"%{filters['q']}%"
+        query = query.filter(or_(Counterparty.brand_name.ilike(pattern), Counterparty.full_name.ilike(pattern)))
+    return api_list(query, api.COUNTERPARTY_FIELDS, Counterparty.id)
+
+@app.route('/api/v1/contracts')
+def api_contracts():
+    return api_list(contracts_list_query(parse_list_filters()), api.CONTRACT_FIELDS, Contract.id)
+
+@app.route('/api/v1/specifications')
+def api_specifications():
+    query = Specification.query.options(
+        joinedload(Specification.contract),
+        selectinload(Specification.services).joinedload(SpecificationService.service_type),
+        selectinload(Specification.services).joinedload(SpecificationService.property_object),
+    )
+    contract_id = request.args.get('contract_id', type=int)
+    if contract_id:
+        query = query.filter(Specification.contract_id == contract_id)
+    return api_list(query, api.SPECIFICATION_FIELDS, Specification.id)
+
+@app.route('/api/v1/realizations')
+def api_realizations():
+    return api_list(realizations_list_query(parse_list_filters()), api.REALIZATION_FIELDS, Realization.id)
+
+@app.route('/api/v1/payments')
+def api_payments():
+    return api_list(payments_list_query(parse_list_filters()), api.PAYMENT_FIELDS, Payment.id,
+                    related={'allocations': payment_allocations})
+
+# --- Отладка ---
+
+@app.route('/debug/requests')
+def debug_requests():
+    """Последние медленные запросы и запросы с повторяющимися SELECT (при SQL_INSTRUMENTATION=1)"""
+    if not app.config['SQL_INSTRUMENTATION']:
+        abort(404)
+    return render_template('debug_requests.html', entries=list(instrumentation.recent_requests),
+                           slow_ms=app.config['SQL_SLOW_REQUEST_MS'],
+                           threshold=app.config['SQL_N_PLUS_ONE_THRESHOLD'])
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,274 @@
+"""Синтетические данные и замеры маршрутов.
+
+seed_synthetic() наполняет БД правдоподобным набором (контрагенты, договоры,
+спецификации с ежемесячными услугами, реализации за K месяцев, платежи с
+частичным распределением) пакетными вставками. measure_routes() прогоняет
+маршруты через тестовый клиент Flask и снимает время, число SQL-запросов и
+пик памяти Python; compare_with_baseline() сверяет результат с сохранённым
+JSON-эталоном. Оркестрация по размерам — в командах flask seed-synthetic и
+flask benchmark (app.py).
+"""
+import gc
+import random
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import event, insert, select
+
+from models import (db, User, Role, Counterparty, CounterpartyType, PropertyObject, PropertyObjectType,
+                    PropertyObjectTypeEnum, ServiceType, ServiceTypeEnum, BusinessCategory, Contract,
+                    ContractStatus, Specification, SpecificationService, BillingType, Realization,
+                    RealizationService, RealizationSource, Payment, PaymentType, PaymentStatus,
+                    payment_realization_association)
+from dictionaries import invalidate_dictionaries
+import reports
+
+CENTS = Decimal('0.01')
+MANAGERS_COUNT = 5
+
+# Метрики замера и допустимый рост относительно эталона
+METRICS = ('wall_ms', 'queries', 'peak_kb')
+WALL_NOISE_MS = 5  # разница меньше этой считается шумом
+
+
+def _month_range(months, today=None):
+    """Последние months месяцев, включая текущий: [(year, month), ...] от старых к новым."""
+    today = today or date.today()
+    year, month = today.year, today.month
+    result = []
+    for _ in range(months):
+        result.append((year, month))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return result[::-1]
+
+
+def _month_end(year, month):
+    return date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+
+
+def _insert(model, rows):
+    """Пакетная вставка с id в порядке строк."""
+    if not rows:
+        return []
+    result = db.session.execute(
+        insert(model).returning(model.id, sort_by_parameter_order=True), rows)
+    return [row.id for row in result]
+
+
+def seed_synthetic(counterparties, contracts, months, seed=None):
+    """Наполняет БД синтетическими данными. Возвращает счётчики созданных записей.
+
+    Договоры распределяются по контрагентам, у каждого договора 1–2 спецификации
+    на весь период, в спецификации ежемесячное размещение на своём павильоне и
+    иногда разовая услуга. Реализации формируются за каждый месяц, платежи —
+    по контрагенту за месяц: часть оплачена полностью, часть частично, часть
+    платежей оставляет аванс.
+    """
+    rnd = random.Random(seed)
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    session = db.session
+
+    categories = session.scalars(select(BusinessCategory.id)).all()
+    service_types = dict(session.execute(select(ServiceType.name, ServiceType.id)).all())
+    pavilion_type_id = session.scalar(
+        select(PropertyObjectType.id).where(PropertyObjectType.name == PropertyObjectTypeEnum.PAVILION))
+    if not categories or not service_types or pavilion_type_id is None:
+        raise RuntimeError('Справочники не заполнены, сначала выполните flask init-db.')
+    period = _month_range(months)
+    period_start = date(*period[0], 1)
+    # Спецификации действуют ещё год после периода, чтобы было что формировать в следующих месяцах
+    last_year, last_month = period[-1]
+    spec_end = _month_end(last_year + 1, last_month)
+    today = date.today()
+
+    manager_ids = _insert(User, [
+        {'email': f'synthetic-{stamp}-{i}@example.com', 'name': f'Менеджер {i}',
+         'role': Role.MANAGER, 'is_active': True}
+        for i in range(1, MANAGERS_COUNT + 1)
+    ])
+    counterparty_ids = _insert(Counterparty, [
+        {'type': rnd.choice(list(CounterpartyType)), 'full_name': f'ООО «Синтетика {stamp}-{i}»',
+         'brand_name': f'Бренд {i:05}'}
+        for i in range(1, counterparties + 1)
+    ])
+    object_ids = _insert(PropertyObject, [
+        {'name': f'Павильон {stamp}-{i}', 'type_id': pavilion_type_id} for i in range(1, contracts + 1)
+    ])
+
+    contract_rows = []
+    for i in range(contracts):
+        contract_rows.append({
+            'number': f'SYN-{stamp}-{i + 1:05}', 'date': period_start,
+            'status': ContractStatus.ACTIVE if rnd.random() < 0.9 else ContractStatus.ARCHIVE,
+            'counterparty_id': counterparty_ids[i % len(counterparty_ids)],
+            'manager_id': rnd.choice(manager_ids), 'category_id': rnd.choice(categories),
+        })
+    contract_ids = _insert(Contract, contract_rows)
+
+    spec_rows = []
+    for contract_id in contract_ids:
+        for number in range(1, rnd.choice((1, 1, 2)) + 1):
+            spec_rows.append({'number': f'№{number} от {period_start:%d.%m.%Y}', 'start_date': period_start,
+                              'end_date': spec_end, 'contract_id': contract_id})
+    spec_ids = _insert(Specification, spec_rows)
+
+    # Одно ежемесячное размещение на спецификацию; павильон договора занимает только первая из них
+    service_rows = []
+    spec_contract_index = {contract_id: index for index, contract_id in enumerate(contract_ids)}
+    used_objects = set()
+    for spec_id, spec in zip(spec_ids, spec_rows):
+        object_id = object_ids[spec_contract_index[spec['contract_id']]]
+        if object_id in used_objects:
+            object_id = None  # иначе павильон оказался бы забронирован дважды
+        used_objects.add(object_id)
+        amount = Decimal(rnd.randrange(5000, 50000, 500))
+        service_rows.append({
+            'specification_id': spec_id, 'property_object_id': object_id,
+            'service_type_id': service_types[ServiceTypeEnum.PLACEMENT], 'billing_type': BillingType.MONTHLY,
+            'description': 'Размещение рекламы', 'start_date': period_start, 'end_date': None, 'amount': amount,
+        })
+        if rnd.random() < 0.3:
+            service_rows.append({
+                'specification_id': spec_id, 'property_object_id': None,
+                'service_type_id': service_types[ServiceTypeEnum.DESIGN], 'billing_type': BillingType.ONE_TIME,
+                'description': 'Дизайн макета', 'start_date': period_start, 'end_date': period_start,
+                'amount': Decimal(rnd.randrange(1000, 10000, 100)),
+            })
+    service_ids = _insert(SpecificationService, service_rows)
+
+    # Реализации по ежемесячным услугам и платежи контрагента за месяц
+    contracts_by_id = dict(zip(contract_ids, contract_rows))
+    specs_by_id = dict(zip(spec_ids, spec_rows))
+    monthly = [(service_id, row) for service_id, row in zip(service_ids, service_rows)
+               if row['billing_type'] == BillingType.MONTHLY]
+    realization_rows, realization_services, payment_plan = [], [], []
+    for year, month in period:
+        by_counterparty = {}
+        for service_id, service in monthly:
+            contract_id = specs_by_id[service['specification_id']]['contract_id']
+            contract = contracts_by_id[contract_id]
+            sale = service['amount']
+            expense = (sale * Decimal(rnd.uniform(0, 0.2))).quantize(CENTS)
+            # Доля оплаты: полностью, частично или ничего — старые месяцы оплачены чаще
+            paid_share = rnd.choice((1, 1, 1, 0.5, 0)) if (year, month) != period[-1] else rnd.choice((1, 0.5, 0, 0))
+            paid = (sale * Decimal(paid_share)).quantize(CENTS)
+            status = (PaymentStatus.NOT_PAID if paid == 0 else
+                      PaymentStatus.PARTIALLY_PAID if paid < sale else PaymentStatus.PAID)
+            index = len(realization_rows)
+            realization_rows.append({
+                'number': f'SYN-{stamp}-{index + 1:07}', 'date': date(year, month, 1),
+                'source': RealizationSource.AUTO, 'year': year, 'month': month,
+                'payment_status': status, 'paid_amount': paid, 'total_sale': sale, 'total_expense': expense,
+                'counterparty_id': contract['counterparty_id'], 'contract_id': contract_id,
+                'specification_id': service['specification_id'], 'specification_service_id': service_id,
+                'manager_id': contract['manager_id'],
+            })
+            realization_services.append({
+                'description': service['description'], 'sale_amount': sale, 'expense_amount': expense,
+                'property_object_id': service['property_object_id'], 'service_type_id': service['service_type_id'],
+            })
+            if paid:
+                by_counterparty.setdefault(contract['counterparty_id'], []).append((index, paid))
+        for counterparty_id, allocations in by_counterparty.items():
+            advance = Decimal(rnd.randrange(1000, 20000, 500)) if rnd.random() < 0.1 else Decimal('0')
+            payment_plan.append((counterparty_id, min(_month_end(year, month), today), allocations, advance))
+
+    realization_ids = _insert(Realization, realization_rows)
+    for realization_id, row in zip(realization_ids, realization_services):
+        row['realization_id'] = realization_id
+    session.execute(insert(RealizationService), realization_services)
+
+    payment_ids = _insert(Payment, [
+        {'date': payment_date, 'initial_amount': sum((paid for _, paid in allocations), advance),
+         'unallocated_amount': advance, 'payment_type': rnd.choice(list(PaymentType)),
+         'counterparty_id': counterparty_id}
+        for counterparty_id, payment_date, allocations, advance in payment_plan
+    ])
+    association = [
+        {'payment_id': payment_id, 'realization_id': realization_ids[index], 'amount': paid}
+        for payment_id, (_, _, allocations, _) in zip(payment_ids, payment_plan)
+        for index, paid in allocations
+    ]
+    if association:
+        session.execute(payment_realization_association.insert(), association)
+
+    reports.refresh_pnl_rollup(period)
+    session.commit()
+    invalidate_dictionaries()
+    return {
+        'managers': len(manager_ids), 'counterparties': len(counterparty_ids), 'property_objects': len(object_ids),
+        'contracts': len(contract_ids), 'specifications': len(spec_ids), 'specification_services': len(service_ids),
+        'realizations': len(realization_ids), 'payments': len(payment_ids), 'allocations': len(association),
+    }
+
+
+def measure_routes(client, routes, repeat=3):
+    """Прогоняет маршруты через тестовый клиент: {название: {wall_ms, queries, peak_kb}}.
+
+    routes — [(название, метод, url, данные формы или None)]; данные могут быть функцией от
+    номера прогона (для POST, который нельзя повторить с теми же данными). Первый прогон
+    считает запросы и пик памяти (tracemalloc сильно замедляет код), следующие repeat
+    прогонов — время, берётся медиана. Ответ с ошибкой (HTTP >= 400) прерывает замер.
+    """
+    engine = db.engine
+    results = {}
+    for name, method, url, data in routes:
+        queries = 0
+
+        def count(*args, **kwargs):
+            nonlocal queries
+            queries += 1
+
+        times = []
+        for attempt in range(repeat + 1):
+            form = data(attempt) if callable(data) else data
+            gc.collect()
+            if attempt == 0:
+                event.listen(engine, 'before_cursor_execute', count)
+                tracemalloc.start()
+            started = time.perf_counter()
+            try:
+                response = client.open(url, method=method, data=form)
+                elapsed = (time.perf_counter() - started) * 1000
+                if attempt == 0:
+                    _, peak = tracemalloc.get_traced_memory()
+            finally:
+                if attempt == 0:
+                    tracemalloc.stop()
+                    event.remove(engine, 'before_cursor_execute', count)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name}: {method} {url} вернул {response.status_code}')
+            if attempt:
+                times.append(elapsed)
+        times.sort()
+        results[name] = {'wall_ms': round(times[len(times) // 2], 1), 'queries': queries, 'peak_kb': peak // 1024}
+    return results
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """Регрессии относительно эталона: список строк «размер / маршрут: метрика было → стало».
+
+    Время и память — регрессия, если выросли больше чем в threshold раз (время — и больше
+    чем на WALL_NOISE_MS); число запросов должно не расти вовсе.
+    """
+    regressions = []
+    for size, routes in results.items():
+        for route, metrics in routes.items():
+            expected = baseline.get(size, {}).get(route)
+            if not expected:
+                continue
+            for metric in METRICS:
+                before, after = expected.get(metric), metrics[metric]
+                if before is None:
+                    continue
+                if metric == 'queries':
+                    regressed = after > before
+                elif metric == 'wall_ms':
+                    regressed = after > before * threshold and after - before > WALL_NOISE_MS
+                else:
+                    regressed = after > before * threshold
+                if regressed:
+                    regressions.append(f'{size} / {route}: {metric} {before} → {after}')
+    return regressions
@@ -0,0 +1,59 @@
+"""Настройки подключения к БД.
+
+Адрес берётся из переменной окружения DATABASE_URL, по умолчанию — файл
+SQLite в instance/. Профили:
+
+- PostgreSQL (``postgresql://...``, драйвер psycopg): пул соединений
+  DB_POOL_SIZE + DB_MAX_OVERFLOW, проверка соединения перед выдачей из пула
+  (pre-ping) и переоткрытие соединений старше DB_POOL_RECYCLE секунд.
+- SQLite: на каждом соединении включаются WAL (читатели не блокируют
+  писателя), busy_timeout (SQLITE_BUSY_TIMEOUT мс ожидания блокировки вместо
+  мгновенного «database is locked») и synchronous=NORMAL.
+"""
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def database_uri(url, default):
+    """URI для SQLAlchemy; postgres:// (Heroku-стиль) приводится к драйверу psycopg."""
+    if not url:
+        return default
+    for prefix in ('postgres://', 'postgresql://'):
+        if url.startswith(prefix):
+            return 'postgresql+psycopg://' + url[len(prefix):]
+    return url
+
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS для выбранного бэкенда."""
+    backend = make_url(uri).get_backend_name()
+    if backend == 'postgresql':
+        return {
+            'pool_size': _env_int('DB_POOL_SIZE', 10),
+            'max_overflow': _env_int('DB_MAX_OVERFLOW', 20),
+            'pool_timeout': _env_int('DB_POOL_TIMEOUT', 30),
+            'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+            'pool_pre_ping': True,
+        }
+    if backend == 'sqlite':
+        # timeout драйвера тоже ждёт блокировку — держим его равным busy_timeout
+        return {'connect_args': {'timeout': _env_int('SQLITE_BUSY_TIMEOUT', 5000) / 1000}}
+    return {}
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f"PRAGMA busy_timeout={_env_int('SQLITE_BUSY_TIMEOUT', 5000)}")
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
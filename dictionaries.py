@@ -0,0 +1,149 @@
+"""Кэш справочников в памяти процесса.
+
+Списки для выпадающих меню (контрагенты, менеджеры, договоры и т.д.) хранятся
+как лёгкие namedtuple-строки; тем же механизмом кэшируются тяжёлые отчёты
+(см. reports.py). Кэш сбрасывается после commit, изменившего таблицу, от которой
+зависит запись: через unit of work или массовым INSERT/UPDATE/DELETE в
+session.execute. Запись в БД в обход сессии должна вызывать
+invalidate_dictionaries() сама. TTL страхует запуск в нескольких процессах,
+где сброс в одном процессе не виден остальным.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import (db, User, Role, Counterparty, PropertyObject, PropertyObjectType, ServiceType,
+                    BusinessCategory, Contract, Specification)
+
+CACHE_TTL = 300  # секунд
+
+CounterpartyItem = namedtuple('CounterpartyItem', 'id brand_name')
+ManagerItem = namedtuple('ManagerItem', 'id name')
+NamedItem = namedtuple('NamedItem', 'id name')
+ContractItem = namedtuple('ContractItem', 'id number counterparty_id counterparty_name')
+SpecificationItem = namedtuple('SpecificationItem', 'id number contract_id contract_number')
+
+_loaders = {}
+_dependencies = {}  # таблица -> имена справочников, которые от неё зависят
+_cache = {}  # имя -> (время загрузки, версия, строки)
+_version = 0
+_lock = threading.Lock()
+
+
+def dictionary(name, *models):
+    """Регистрирует загрузчик справочника и модели (или таблицы), изменение которых его сбрасывает."""
+    def decorator(loader):
+        _loaders[name] = loader
+        for model in models:
+            _dependencies.setdefault(getattr(model, '__table__', model), set()).add(name)
+        return loader
+    return decorator
+
+
+def get_dictionary(name):
+    entry = _cache.get(name)
+    if entry is not None and entry[1] == _version and time.monotonic() - entry[0] < CACHE_TTL:
+        return entry[2]
+    version = _version
+    items = _loaders[name]()
+    with _lock:
+        # Пока читали из БД, справочник могли изменить — тогда результат не сохраняем
+        if version == _version:
+            _cache[name] = (time.monotonic(), version, items)
+    return items
+
+
+def invalidate_dictionaries(*names):
+    """Сбрасывает перечисленные справочники (или все, если имена не переданы)."""
+    global _version
+    with _lock:
+        _version += 1
+        for name in names or list(_cache):
+            _cache.pop(name, None)
+
+
+@dictionary('counterparties', Counterparty)
+def _load_counterparties():
+    rows = db.session.execute(
+        select(Counterparty.id, Counterparty.brand_name).order_by(Counterparty.brand_name))
+    return [CounterpartyItem(*row) for row in rows]
+
+
+@dictionary('managers', User)
+def _load_managers():
+    rows = db.session.execute(
+        select(User.id, User.name).where(User.role == Role.MANAGER).order_by(User.name))
+    return [ManagerItem(*row) for row in rows]
+
+
+@dictionary('categories', BusinessCategory)
+def _load_categories():
+    rows = db.session.execute(select(BusinessCategory.id, BusinessCategory.name).order_by(BusinessCategory.name))
+    return [NamedItem(*row) for row in rows]
+
+
+@dictionary('service_types', ServiceType)
+def _load_service_types():
+    rows = db.session.execute(select(ServiceType.id, ServiceType.name).order_by(ServiceType.name))
+    return [NamedItem(*row) for row in rows]
+
+
+@dictionary('object_types', PropertyObjectType)
+def _load_object_types():
+    rows = db.session.execute(select(PropertyObjectType.id, PropertyObjectType.name).order_by(PropertyObjectType.name))
+    return [NamedItem(*row) for row in rows]
+
+
+@dictionary('property_objects', PropertyObject)
+def _load_property_objects():
+    rows = db.session.execute(select(PropertyObject.id, PropertyObject.name).order_by(PropertyObject.name))
+    return [NamedItem(*row) for row in rows]
+
+
+@dictionary('contracts', Contract, Counterparty)
+def _load_contracts():
+    rows = db.session.execute(
+        select(Contract.id, Contract.number, Contract.counterparty_id, Counterparty.brand_name)
+        .join(Counterparty, Counterparty.id == Contract.counterparty_id)
+        .order_by(Contract.number))
+    return [ContractItem(*row) for row in rows]
+
+
+@dictionary('specifications', Specification, Contract)
+def _load_specifications():
+    rows = db.session.execute(
+        select(Specification.id, Specification.number, Specification.contract_id, Contract.number)
+        .join(Contract, Contract.id == Specification.contract_id)
+        .order_by(Specification.number))
+    return [SpecificationItem(*row) for row in rows]
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_dictionaries(session, flush_context):
+    changed = session.info.setdefault('changed_dictionaries', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        changed.update(_dependencies.get(type(obj).__table__, ()))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk_changes(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    names = _dependencies.get(getattr(orm_execute_state.statement, 'table', None))
+    if names:
+        orm_execute_state.session.info.setdefault('changed_dictionaries', set()).update(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_dictionaries(session):
+    changed = session.info.pop('changed_dictionaries', None)
+    if changed:
+        invalidate_dictionaries(*changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changed_dictionaries(session):
+    session.info.pop('changed_dictionaries', None)
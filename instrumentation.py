@@ -0,0 +1,135 @@
+"""Учёт SQL-запросов по HTTP-запросам (включается SQL_INSTRUMENTATION=1).
+
+Слушатели событий движка считают запросы и время БД, пока обрабатывается
+HTTP-запрос. Запросы группируются по нормализованному SQL (литералы и списки
+IN заменены на ?): один и тот же SELECT, выполненный SQL_N_PLUS_ONE_THRESHOLD
+раз и больше, помечается как вероятный N+1 — обычно это ленивая загрузка
+связи в цикле шаблона или свойстве модели.
+
+Итог отдаётся в заголовках X-DB-Queries и X-DB-Time, панелью внизу HTML-
+страниц и на странице /debug/requests: туда попадают последние медленные
+(дольше SQL_SLOW_REQUEST_MS) запросы и запросы с подозрением на N+1.
+"""
+import re
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+# Последние медленные и подозрительные запросы — общий буфер процесса
+recent_requests = deque(maxlen=100)
+
+
+def normalize_sql(statement):
+    """SQL без литералов и с IN (?, ?, ...) → IN (?) — ключ группировки повторов."""
+    statement = _LITERALS.sub('?', statement)
+    statement = _PARAM_LISTS.sub('(?)', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+
+class RequestStats:
+    """Запросы одного HTTP-запроса, сгруппированные по нормализованному SQL."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.db_ms = 0.0
+        self.statements = {}  # нормализованный SQL → [число выполнений, время, мс]
+
+    def add(self, statement, elapsed_ms):
+        self.count += 1
+        self.db_ms += elapsed_ms
+        entry = self.statements.setdefault(normalize_sql(statement), [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed_ms
+
+    def repeated(self, threshold):
+        """Повторяющиеся SELECT — кандидаты в N+1: [(SQL, число, мс)] по убыванию числа."""
+        return sorted(
+            ((sql, count, ms) for sql, (count, ms) in self.statements.items()
+             if count >= threshold and sql.upper().startswith('SELECT')),
+            key=lambda item: item[1], reverse=True)
+
+    def top(self, limit=10):
+        """Самые затратные по суммарному времени запросы: [(SQL, число, мс)]."""
+        items = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+        return [(sql, count, ms) for sql, (count, ms) in items[:limit]]
+
+
+def current_stats():
+    """Счётчики текущего HTTP-запроса или None (вне запроса или учёт выключен)."""
+    if not has_request_context():
+        return None
+    return g.get('sql_stats')
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    # Время начала — на контексте выполнения, а не на соединении из пула: after_cursor_execute
+    # не вызывается, если запрос упал, и запись на соединении осталась бы навсегда
+    if context is not None and current_stats() is not None:
+        context.sql_stats_started = time.perf_counter()
+
+
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = getattr(context, 'sql_stats_started', None)
+    if stats is None or started is None:
+        return
+    stats.add(statement, (time.perf_counter() - started) * 1000)
+
+
+def init_app(app):
+    """Подключает учёт к приложению, если включён SQL_INSTRUMENTATION."""
+    app.config.setdefault('SQL_SLOW_REQUEST_MS', 200)
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 5)
+    if not app.config.get('SQL_INSTRUMENTATION'):
+        return
+    event.listen(Engine, 'before_cursor_execute', _start_timer)
+    event.listen(Engine, 'after_cursor_execute', _stop_timer)
+
+    @app.before_request
+    def _begin_request():
+        if request.endpoint != 'static':
+            g.sql_stats = RequestStats()
+
+    @app.after_request
+    def _finish_request(response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+        total_ms = (time.perf_counter() - stats.started) * 1000
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time'] = f'{stats.db_ms:.1f}'
+        repeated = stats.repeated(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+        if repeated:
+            response.headers['X-DB-N-Plus-One'] = str(len(repeated))
+        if (total_ms >= app.config['SQL_SLOW_REQUEST_MS'] or repeated) and request.endpoint != 'debug_requests':
+            recent_requests.appendleft({
+                'at': datetime.now(),
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'form_type': request.form.get('form_type') if request.method == 'POST' else None,
+                'status': response.status_code,
+                'total_ms': total_ms,
+                'db_ms': stats.db_ms,
+                'queries': stats.count,
+                'repeated': repeated,
+                'top': stats.top(),
+            })
+        return response
+
+    @app.context_processor
+    def _debug_toolbar():
+        # Объект счётчиков, а не готовые числа: панель внизу страницы покажет и запросы,
+        # выполненные при отрисовке шаблона (ленивые загрузки)
+        stats = current_stats()
+        if stats is None:
+            return {}
+        return {'sql_stats': stats, 'sql_n_plus_one_threshold': app.config['SQL_N_PLUS_ONE_THRESHOLD']}
@@ -0,0 +1,68 @@
+"""add pnl rollup
+
+Revision ID: 4b9e1f27c3d8
+Revises: c7e2d84b1f65
+Create Date: 2025-11-06 11:20:43.519204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b9e1f27c3d8'
+down_revision = 'c7e2d84b1f65'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pnl_rollup',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Integer(), nullable=False),
+    sa.Column('manager_id', sa.Integer(), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=True),
+    sa.Column('service_type_id', sa.Integer(), nullable=False),
+    sa.Column('property_object_id', sa.Integer(), nullable=True),
+    sa.Column('sale_amount', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('expense_amount', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('services_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['business_category.id'], ),
+    sa.ForeignKeyConstraint(['manager_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['property_object_id'], ['property_object.id'], ),
+    sa.ForeignKeyConstraint(['service_type_id'], ['service_type.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('pnl_rollup', schema=None) as batch_op:
+        batch_op.create_index('ix_pnl_rollup_period', ['year', 'month'], unique=False)
+
+    # Начальное заполнение свода по уже существующим услугам реализаций
+    realization = sa.table('realization', sa.column('id'), sa.column('date'), sa.column('manager_id'),
+                           sa.column('contract_id'))
+    service = sa.table('realization_service', sa.column('id'), sa.column('realization_id'),
+                       sa.column('service_type_id'), sa.column('property_object_id'),
+                       sa.column('sale_amount'), sa.column('expense_amount'))
+    contract = sa.table('contract', sa.column('id'), sa.column('category_id'))
+    rollup = sa.table('pnl_rollup', *(sa.column(name) for name in (
+        'year', 'month', 'manager_id', 'category_id', 'service_type_id', 'property_object_id',
+        'sale_amount', 'expense_amount', 'services_count')))
+    year = sa.extract('year', realization.c.date)
+    month = sa.extract('month', realization.c.date)
+    dimensions = (year, month, realization.c.manager_id, contract.c.category_id,
+                  service.c.service_type_id, service.c.property_object_id)
+    op.execute(rollup.insert().from_select(
+        [column.name for column in rollup.c],
+        sa.select(*dimensions, sa.func.sum(service.c.sale_amount),
+                  sa.func.sum(sa.func.coalesce(service.c.expense_amount, 0)), sa.func.count(service.c.id))
+        .select_from(service.join(realization, realization.c.id == service.c.realization_id)
+                     .outerjoin(contract, contract.c.id == realization.c.contract_id))
+        .group_by(*dimensions)
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('pnl_rollup', schema=None) as batch_op:
+        batch_op.drop_index('ix_pnl_rollup_period')
+
+    op.drop_table('pnl_rollup')
@@ -0,0 +1,34 @@
+"""drop partial indexes duplicating counterparty/date indexes
+
+Revision ID: 6f2b8d14a9c3
+Revises: 9d3a6c51e0b2
+Create Date: 2025-11-14 09:41:05.218730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f2b8d14a9c3'
+down_revision = '9d3a6c51e0b2'
+branch_labels = None
+depends_on = None
+
+# Ключ тот же, что у ix_realization_counterparty_date / ix_payment_counterparty_date:
+# планировщик выбирает полный индекс, а частичный только замедляет запись
+INDEXES = [
+    ('realization', 'ix_realization_outstanding', ['counterparty_id', 'date', 'id'], 'total_sale > paid_amount'),
+    ('payment', 'ix_payment_open_advance', ['counterparty_id', 'date', 'id'], 'unallocated_amount > 0'),
+]
+
+
+def upgrade():
+    for table, name, _, _ in INDEXES:
+        op.drop_index(name, table_name=table)
+
+
+def downgrade():
+    for table, name, columns, where in INDEXES:
+        op.create_index(name, table, columns, unique=False,
+                        sqlite_where=sa.text(where), postgresql_where=sa.text(where))
@@ -0,0 +1,52 @@
+"""add index pack for list filters and joins
+
+Revision ID: 9d3a6c51e0b2
+Revises: 4b9e1f27c3d8
+Create Date: 2025-11-07 10:02:18.447091
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3a6c51e0b2'
+down_revision = '4b9e1f27c3d8'
+branch_labels = None
+depends_on = None
+
+# (таблица, индекс, колонки, условие частичного индекса)
+INDEXES = [
+    ('counterparty', 'ix_counterparty_brand_name', ['brand_name', 'id'], None),
+    ('contract', 'ix_contract_date', ['date', 'id'], None),
+    ('contract', 'ix_contract_counterparty_date', ['counterparty_id', 'date', 'id'], None),
+    ('contract', 'ix_contract_manager_date', ['manager_id', 'date', 'id'], None),
+    ('contract', 'ix_contract_status', ['status'], None),
+    ('specification', 'ix_specification_contract_dates', ['contract_id', 'start_date', 'end_date'], None),
+    ('specification_service', 'ix_specification_service_spec_billing', ['specification_id', 'billing_type'], None),
+    ('specification_service', 'ix_specification_service_object', ['property_object_id'], None),
+    ('realization', 'ix_realization_date', ['date', 'id'], None),
+    ('realization', 'ix_realization_counterparty_date', ['counterparty_id', 'date', 'id'], None),
+    ('realization', 'ix_realization_manager_date', ['manager_id', 'date', 'id'], None),
+    ('realization', 'ix_realization_status_date', ['payment_status', 'date', 'id'], None),
+    ('realization', 'ix_realization_contract_period', ['contract_id', 'specification_id', 'year', 'month'], None),
+    ('realization', 'ix_realization_specification', ['specification_id'], None),
+    ('realization', 'ix_realization_outstanding', ['counterparty_id', 'date', 'id'], 'total_sale > paid_amount'),
+    ('realization_service', 'ix_realization_service_realization', ['realization_id'], None),
+    ('realization_service', 'ix_realization_service_object', ['property_object_id'], None),
+    ('payment_realization_association', 'ix_payment_realization_realization', ['realization_id'], None),
+    ('payment', 'ix_payment_date', ['date', 'id'], None),
+    ('payment', 'ix_payment_counterparty_date', ['counterparty_id', 'date', 'id'], None),
+    ('payment', 'ix_payment_open_advance', ['counterparty_id', 'date', 'id'], 'unallocated_amount > 0'),
+]
+
+
+def upgrade():
+    for table, name, columns, where in INDEXES:
+        partial = {'sqlite_where': sa.text(where), 'postgresql_where': sa.text(where)} if where else {}
+        op.create_index(name, table, columns, unique=False, **partial)
+
+
+def downgrade():
+    for table, name, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
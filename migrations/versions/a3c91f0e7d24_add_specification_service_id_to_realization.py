@@ -0,0 +1,66 @@
+"""add specification_service_id to realization
+
+Revision ID: a3c91f0e7d24
+Revises: 5eac254326c8
+Create Date: 2025-11-03 10:12:41.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c91f0e7d24'
+down_revision = '5eac254326c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('realization', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('specification_service_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_realization_specification_service_id', 'specification_service',
+                                    ['specification_service_id'], ['id'], ondelete='SET NULL')
+
+    # Проставляем ключ уже созданным AUTO-реализациям: сопоставляем по спецификации и описанию услуги,
+    # как это делала старая проверка. Одна услуга спецификации — не более одной реализации за месяц.
+    bind = op.get_bind()
+    services = bind.execute(sa.text(
+        "SELECT id, specification_id, description FROM specification_service "
+        "WHERE billing_type = 'MONTHLY' ORDER BY id"
+    )).fetchall()
+    services_by_key = {}
+    for row in services:
+        services_by_key.setdefault((row.specification_id, row.description), []).append(row.id)
+
+    realizations = bind.execute(sa.text(
+        "SELECT r.id, r.specification_id, r.year, r.month, rs.description "
+        "FROM realization r JOIN realization_service rs ON rs.realization_id = r.id "
+        "WHERE r.source = 'AUTO' ORDER BY r.id, rs.id"
+    )).fetchall()
+    taken = set()
+    assigned = set()
+    for row in realizations:
+        if row.id in assigned:
+            continue
+        for service_id in services_by_key.get((row.specification_id, row.description), []):
+            key = (service_id, row.year, row.month)
+            if key in taken:
+                continue
+            bind.execute(sa.text(
+                "UPDATE realization SET specification_service_id = :service_id WHERE id = :id"
+            ), {'service_id': service_id, 'id': row.id})
+            taken.add(key)
+            assigned.add(row.id)
+            break
+
+    with op.batch_alter_table('realization', schema=None) as batch_op:
+        batch_op.create_index('ix_realization_spec_service_period',
+                              ['specification_service_id', 'year', 'month'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('realization', schema=None) as batch_op:
+        batch_op.drop_index('ix_realization_spec_service_period')
+        batch_op.drop_constraint('fk_realization_specification_service_id', type_='foreignkey')
+        batch_op.drop_column('specification_service_id')
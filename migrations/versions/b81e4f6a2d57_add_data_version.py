@@ -0,0 +1,61 @@
+"""add data_version counters and triggers for API ETags
+
+Revision ID: b81e4f6a2d57
+Revises: 6f2b8d14a9c3
+Create Date: 2025-11-14 15:12:47.903311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81e4f6a2d57'
+down_revision = '6f2b8d14a9c3'
+branch_labels = None
+depends_on = None
+
+# Таблицы JSON API: запись в любую из них увеличивает её счётчик в data_version
+TABLES = ['user', 'counterparty', 'property_object', 'service_type', 'contract', 'specification',
+          'specification_service', 'realization', 'realization_service', 'payment',
+          'payment_realization_association']
+OPERATIONS = ['insert', 'update', 'delete']
+
+
+def upgrade():
+    data_version = op.create_table('data_version',
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(data_version, [{'table_name': table, 'version': 0} for table in TABLES])
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("""
+            CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN
+                UPDATE data_version SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+                RETURN NULL;
+            END $$
+        """)
+        for table in TABLES:
+            op.execute(f'CREATE TRIGGER trg_{table}_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE '
+                       f'ON "{table}" FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()')
+    else:
+        # SQLite: триггеры только на строку
+        for table in TABLES:
+            for operation in OPERATIONS:
+                op.execute(f'CREATE TRIGGER trg_{table}_{operation}_data_version AFTER {operation.upper()} '
+                           f'ON "{table}" BEGIN UPDATE data_version SET version = version + 1 '
+                           f"WHERE table_name = '{table}'; END")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in TABLES:
+            op.execute(f'DROP TRIGGER IF EXISTS trg_{table}_data_version ON "{table}"')
+        op.execute('DROP FUNCTION IF EXISTS bump_data_version()')
+    else:
+        for table in TABLES:
+            for operation in OPERATIONS:
+                op.execute(f'DROP TRIGGER IF EXISTS trg_{table}_{operation}_data_version')
+    op.drop_table('data_version')
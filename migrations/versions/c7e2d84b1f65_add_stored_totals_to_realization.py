@@ -0,0 +1,42 @@
+"""add stored totals to realization
+
+Revision ID: c7e2d84b1f65
+Revises: a3c91f0e7d24
+Create Date: 2025-11-04 09:41:27.803115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e2d84b1f65'
+down_revision = 'a3c91f0e7d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite не поддерживает добавление NOT NULL колонки напрямую:
+    # добавляем с server_default, заполняем итоги по услугам, затем снимаем default
+    with op.batch_alter_table('realization', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('total_sale', sa.Numeric(precision=10, scale=2), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('total_expense', sa.Numeric(precision=10, scale=2), nullable=False, server_default='0'))
+
+    op.execute("""
+        UPDATE realization SET
+            total_sale = COALESCE((SELECT SUM(rs.sale_amount) FROM realization_service rs
+                                   WHERE rs.realization_id = realization.id), 0),
+            total_expense = COALESCE((SELECT SUM(COALESCE(rs.expense_amount, 0)) FROM realization_service rs
+                                      WHERE rs.realization_id = realization.id), 0)
+    """)
+
+    with op.batch_alter_table('realization', schema=None) as batch_op:
+        batch_op.alter_column('total_sale', server_default=None)
+        batch_op.alter_column('total_expense', server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('realization', schema=None) as batch_op:
+        batch_op.drop_column('total_expense')
+        batch_op.drop_column('total_sale')
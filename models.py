@@ -1,4 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, case, cast
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, object_session
 import enum
 from datetime import datetime
 from decimal import Decimal
@@ -88,6 +91,10 @@ class Counterparty(db.Model):
     contacts = db.Column(db.JSON)
     notes = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index('ix_counterparty_brand_name', 'brand_name', 'id'),  # сортировка и keyset списков
+    )
+
     def __repr__(self):
         return f'<Counterparty {self.brand_name}>'
 
@@ -140,6 +147,13 @@ class Contract(db.Model):
     manager = db.relationship('User', backref=db.backref('contracts', lazy=True))
     category = db.relationship('BusinessCategory', backref=db.backref('contracts', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_contract_date', 'date', 'id'),
+        db.Index('ix_contract_counterparty_date', 'counterparty_id', 'date', 'id'),
+        db.Index('ix_contract_manager_date', 'manager_id', 'date', 'id'),
+        db.Index('ix_contract_status', 'status'),
+    )
+
     def __repr__(self):
         return f'<Contract {self.number}>'
 
@@ -153,6 +167,11 @@ class Specification(db.Model):
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), nullable=False)
     contract = db.relationship('Contract', backref=db.backref('specifications', lazy=True, cascade="all, delete-orphan"))
 
+    __table_args__ = (
+        # Генерация реализаций: спецификации договора, действующие в месяце
+        db.Index('ix_specification_contract_dates', 'contract_id', 'start_date', 'end_date'),
+    )
+
     def __repr__(self):
         return f'<Specification {self.number} for Contract {self.contract.number}>'
 
@@ -171,6 +190,11 @@ class SpecificationService(db.Model):
     specification = db.relationship('Specification', backref=db.backref('services', lazy=True, cascade="all, delete-orphan"))
     property_object = db.relationship('PropertyObject')
     service_type = db.relationship('ServiceType')
+
+    __table_args__ = (
+        db.Index('ix_specification_service_spec_billing', 'specification_id', 'billing_type'),
+        db.Index('ix_specification_service_object', 'property_object_id'),
+    )
     
     def __repr__(self):
         return f'<SpecificationService {self.id}>'
@@ -184,34 +208,58 @@ class Realization(db.Model):
     year = db.Column(db.Integer) # Год реализации
     payment_status = db.Column(db.Enum(PaymentStatus), default=PaymentStatus.NOT_PAID, nullable=False)
     paid_amount = db.Column(db.Numeric(10, 2), nullable=False, default=0)  # Сколько уже оплачено по этой реализации
+    # Итоги по услугам хранятся в самой реализации и пересчитываются при изменении услуг (см. _sync_realization_totals)
+    total_sale = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    total_expense = db.Column(db.Numeric(10, 2), nullable=False, default=0)
 
     counterparty_id = db.Column(db.Integer, db.ForeignKey('counterparty.id'), nullable=False)
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'))
     specification_id = db.Column(db.Integer, db.ForeignKey('specification.id'))
     manager_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    
+    # Услуга спецификации, по которой сформирована AUTO-реализация (ключ идемпотентности генерации)
+    specification_service_id = db.Column(db.Integer, db.ForeignKey('specification_service.id', ondelete='SET NULL'))
+
     counterparty = db.relationship('Counterparty', backref='realizations')
     contract = db.relationship('Contract', backref='realizations')
     specification = db.relationship('Specification', backref='realizations')
     manager = db.relationship('User', backref='realizations')
+    specification_service = db.relationship('SpecificationService', backref='realizations')
+
+    __table_args__ = (
+        db.Index('ix_realization_spec_service_period', 'specification_service_id', 'year', 'month', unique=True),
+        # Списки реализаций: keyset по (date, id), в том числе внутри фильтра
+        db.Index('ix_realization_date', 'date', 'id'),
+        db.Index('ix_realization_counterparty_date', 'counterparty_id', 'date', 'id'),
+        db.Index('ix_realization_manager_date', 'manager_id', 'date', 'id'),
+        db.Index('ix_realization_status_date', 'payment_status', 'date', 'id'),
+        db.Index('ix_realization_contract_period', 'contract_id', 'specification_id', 'year', 'month'),
+        db.Index('ix_realization_specification', 'specification_id'),
+    )
+
+    @hybrid_property
+    def total_profit(self):
+        return (self.total_sale or 0) - (self.total_expense or 0)
 
-    @property
-    def total_sale(self):
-        return sum(service.sale_amount for service in self.services)
+    @total_profit.expression
+    def total_profit(cls):
+        return cls.total_sale - cls.total_expense
 
-    @property
-    def total_expense(self):
-        return sum(service.expense_amount for service in self.services)
-    
-    @property
-    def total_profit(self):
-        return self.total_sale - self.total_expense
-    
-    @property
+    @hybrid_property
     def debt_amount(self):
         """Остаток долга по реализации"""
-        return max(Decimal('0'), Decimal(str(self.total_sale)) - Decimal(str(self.paid_amount)))
-    
+        return max(Decimal('0'), Decimal(str(self.total_sale or 0)) - Decimal(str(self.paid_amount or 0)))
+
+    @debt_amount.expression
+    def debt_amount(cls):
+        return case((cls.total_sale > cls.paid_amount, cls.total_sale - cls.paid_amount), else_=0)
+
+    def recalculate_totals(self):
+        """Пересчёт сохранённых итогов по услугам реализации"""
+        session = object_session(self)
+        services = [s for s in self.services if session is None or s not in session.deleted]
+        self.total_sale = sum((Decimal(str(s.sale_amount or 0)) for s in services), Decimal('0'))
+        self.total_expense = sum((Decimal(str(s.expense_amount or 0)) for s in services), Decimal('0'))
+
     def update_payment_status(self):
         """Автоматическое обновление статуса оплаты"""
         total = Decimal(str(self.total_sale))
@@ -224,6 +272,18 @@ class Realization(db.Model):
         else:
             self.payment_status = PaymentStatus.PAID
 
+    @classmethod
+    def payment_status_expression(cls):
+        """SQL-вариант update_payment_status для массовых UPDATE (Enum хранится в БД по имени).
+
+        CAST к типу колонки нужен PostgreSQL, где Enum — отдельный тип, а не строка.
+        """
+        return cast(case(
+            (cls.paid_amount == 0, PaymentStatus.NOT_PAID.name),
+            (cls.paid_amount < cls.total_sale, PaymentStatus.PARTIALLY_PAID.name),
+            else_=PaymentStatus.PAID.name,
+        ), cls.__table__.c.payment_status.type)
+
 class RealizationService(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.Text)
@@ -238,11 +298,62 @@ class RealizationService(db.Model):
     property_object = db.relationship('PropertyObject')
     service_type = db.relationship('ServiceType')
 
+    __table_args__ = (
+        db.Index('ix_realization_service_realization', 'realization_id'),
+        db.Index('ix_realization_service_object', 'property_object_id'),
+    )
+
+@event.listens_for(Session, 'before_flush')
+def _sync_realization_totals(session, flush_context, instances):
+    """Поддерживает Realization.total_sale/total_expense в актуальном состоянии.
+
+    Пересчитываются только реализации, чьи услуги добавлены, изменены или удалены в этом flush.
+    Массовые вставки через Core (генерация реализаций) заполняют итоги сами.
+    """
+    affected = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, RealizationService):
+            continue
+        realization = obj.realization
+        if realization is None and obj.realization_id is not None:
+            realization = session.get(Realization, obj.realization_id)
+            if realization is not None and obj not in session.deleted and obj not in realization.services:
+                realization.services.append(obj)
+        if realization is not None:
+            affected.add(realization)
+
+    for realization in affected:
+        if realization not in session.deleted:
+            realization.recalculate_totals()
+
+class PnlRollup(db.Model):
+    """Помесячный свод продаж и расходов по услугам реализаций для отчёта P&L.
+
+    Строка — месяц даты реализации × менеджер × категория бизнеса (из договора) × тип услуги × объект.
+    Свод поддерживается по затронутым месяцам при commit (см. reports.py); полная пересборка —
+    flask rebuild-rollups.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    manager_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('business_category.id'))  # NULL — разовая реализация без договора
+    service_type_id = db.Column(db.Integer, db.ForeignKey('service_type.id'), nullable=False)
+    property_object_id = db.Column(db.Integer, db.ForeignKey('property_object.id'))
+    sale_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    expense_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    services_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_pnl_rollup_period', 'year', 'month'),
+    )
+
 # Таблица связи "многие-ко-многим" между Payment и Realization
 payment_realization_association = db.Table('payment_realization_association',
     db.Column('payment_id', db.Integer, db.ForeignKey('payment.id'), primary_key=True),
     db.Column('realization_id', db.Integer, db.ForeignKey('realization.id'), primary_key=True),
-    db.Column('amount', db.Numeric(10, 2), nullable=False)  # Сколько именно зачтено на эту реализацию
+    db.Column('amount', db.Numeric(10, 2), nullable=False),  # Сколько именно зачтено на эту реализацию
+    db.Index('ix_payment_realization_realization', 'realization_id'),
 )
 
 class Payment(db.Model):
@@ -262,5 +373,67 @@ class Payment(db.Model):
                                    backref='payments',
                                    lazy='dynamic')
     
+    __table_args__ = (
+        db.Index('ix_payment_date', 'date', 'id'),
+        db.Index('ix_payment_counterparty_date', 'counterparty_id', 'date', 'id'),
+    )
+
     def __repr__(self):
         return f'<Payment {self.id} {self.date} {self.initial_amount}>'
+
+class DataVersion(db.Model):
+    """Счётчик изменений таблицы для ETag JSON API (api.py).
+
+    Счётчик увеличивает триггер БД в той же транзакции, что и запись, поэтому версию
+    меняет commit любого клиента БД — других процессов, миграций, ручного SQL.
+    """
+    __tablename__ = 'data_version'
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+# Таблицы, данные которых отдаёт JSON API
+VERSIONED_TABLES = ('user', 'counterparty', 'property_object', 'service_type', 'contract', 'specification',
+                    'specification_service', 'realization', 'realization_service', 'payment',
+                    'payment_realization_association')
+
+
+def data_version_ddl(dialect_name):
+    """DDL триггеров, увеличивающих data_version.version; повторный запуск безопасен.
+
+    SQLite умеет только триггеры на строку; в PostgreSQL триггер на оператор, поэтому
+    массовая вставка увеличивает счётчик один раз.
+    """
+    statements = []
+    if dialect_name == 'sqlite':
+        for table in VERSIONED_TABLES:
+            for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                statements.append(
+                    f'CREATE TRIGGER IF NOT EXISTS trg_{table}_{operation.lower()}_data_version '
+                    f'AFTER {operation} ON "{table}" BEGIN '
+                    f"UPDATE data_version SET version = version + 1 WHERE table_name = '{table}'; END")
+    elif dialect_name == 'postgresql':
+        statements.append(
+            'CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN '
+            'UPDATE data_version SET version = version + 1 WHERE table_name = TG_TABLE_NAME; '
+            'RETURN NULL; END $$')
+        for table in VERSIONED_TABLES:
+            statements.append(f'DROP TRIGGER IF EXISTS trg_{table}_data_version ON "{table}"')
+            statements.append(
+                f'CREATE TRIGGER trg_{table}_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE '
+                f'ON "{table}" FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()')
+    else:
+        raise NotImplementedError(f'Триггеры data_version не описаны для {dialect_name}')
+    return statements
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_data_version_triggers(target, connection, **kw):
+    # db.create_all (тесты, замеры, seed) создаёт схему без миграций — триггеры ставятся здесь же
+    table = DataVersion.__table__
+    existing = set(connection.execute(db.select(table.c.table_name)).scalars())
+    missing = [{'table_name': name, 'version': 0} for name in VERSIONED_TABLES if name not in existing]
+    if missing:
+        connection.execute(table.insert(), missing)
+    for statement in data_version_ddl(connection.dialect.name):
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,91 @@
+"""Занятость рекламных объектов по услугам размещения.
+
+Интервалы занятости берутся из услуг спецификаций с типом «Размещение» и
+привязанным объектом; услуга без даты окончания занимает объект до конца
+спецификации.
+
+Проверка двойного бронирования при сохранении услуги (find_conflict) —
+всегда запрос к БД по индексу ix_specification_service_object: кэш процесса
+не видит броней, сохранённых другим процессом. Для страницы занятости
+(availability) индекс всех броней строится в памяти и кэшируется через
+dictionaries.py до commit, изменившего услуги, спецификации или договоры;
+брони каждого объекта отсортированы по началу, пересечения с периодом
+находятся бисекцией.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+
+from sqlalchemy import select, func
+
+from models import db, Counterparty, Contract, Specification, SpecificationService, ServiceType, ServiceTypeEnum
+from dictionaries import dictionary, get_dictionary
+
+# Типы услуг, которые занимают объект на период
+OCCUPYING_SERVICE_TYPES = (ServiceTypeEnum.PLACEMENT,)
+
+Booking = namedtuple('Booking', 'service_id object_id start end contract_id contract_number counterparty_name')
+
+# Окончание брони: дата окончания услуги или, если не задана, спецификации
+BOOKING_END = func.coalesce(SpecificationService.end_date, Specification.end_date)
+
+
+class ObjectSchedule:
+    """Брони одного объекта, отсортированные по началу."""
+
+    def __init__(self, bookings):
+        self.bookings = sorted(bookings, key=lambda booking: (booking.start, booking.service_id))
+        self._starts = [booking.start for booking in self.bookings]
+
+    def overlapping(self, start, end):
+        """Все брони, пересекающиеся с периодом [start, end] (границы включительно)."""
+        return [booking for booking in self.bookings[:bisect_right(self._starts, end)] if booking.end >= start]
+
+
+def _bookings_query():
+    """Брони — услуги занимающих типов с привязанным объектом, в порядке полей Booking."""
+    return (
+        select(SpecificationService.id, SpecificationService.property_object_id, SpecificationService.start_date,
+               BOOKING_END, Contract.id, Contract.number, Counterparty.brand_name)
+        .join(Specification, Specification.id == SpecificationService.specification_id)
+        .join(Contract, Contract.id == Specification.contract_id)
+        .join(Counterparty, Counterparty.id == Contract.counterparty_id)
+        .join(ServiceType, ServiceType.id == SpecificationService.service_type_id)
+        .where(SpecificationService.property_object_id.isnot(None),
+               ServiceType.name.in_(OCCUPYING_SERVICE_TYPES))
+    )
+
+
+@dictionary('occupancy', SpecificationService, Specification, Contract, Counterparty, ServiceType)
+def _build_occupancy_index():
+    by_object = {}
+    for row in db.session.execute(_bookings_query()):
+        by_object.setdefault(row[1], []).append(Booking(*row))
+    return {object_id: ObjectSchedule(bookings) for object_id, bookings in by_object.items()}
+
+
+def is_occupying(service_type_id):
+    """Занимает ли услуга этого типа объект на период."""
+    return any(item.id == service_type_id and item.name in OCCUPYING_SERVICE_TYPES
+               for item in get_dictionary('service_types'))
+
+
+def find_conflict(object_id, start, end, exclude_service_id=None):
+    """Бронь объекта, пересекающаяся с периодом, кроме услуги exclude_service_id; None — объект свободен.
+
+    Читает БД, а не кэш: проверка перед записью должна видеть брони всех процессов.
+    """
+    query = _bookings_query().where(SpecificationService.property_object_id == object_id,
+                                    SpecificationService.start_date <= end, BOOKING_END >= start)
+    if exclude_service_id is not None:
+        query = query.where(SpecificationService.id != exclude_service_id)
+    row = db.session.execute(query.order_by(SpecificationService.start_date).limit(1)).first()
+    return Booking(*row) if row else None
+
+
+def availability(start, end):
+    """Объекты из справочника с бронями за период: [(объект, [брони])], пустой список броней — свободен."""
+    index = get_dictionary('occupancy')
+    return [
+        (item, index[item.id].overlapping(start, end) if item.id in index else [])
+        for item in get_dictionary('property_objects')
+    ]
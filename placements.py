@@ -0,0 +1,437 @@
+"""Импорт истории размещений из рабочей книги «Размещение рекламы 2025».
+
+Строки листов «Договор» и «Архив» читаются потоком (openpyxl read_only) и
+обрабатываются пачками: недостающие контрагенты, объекты, договоры,
+спецификации и услуги ищутся по словарям в памяти, загруженным один раз,
+и вставляются пакетно — по одному INSERT на уровень иерархии в каждой пачке,
+пачка — одна транзакция. В режиме dry-run в БД ничего не пишется, новым
+строкам выдаются временные отрицательные id, а на выходе — план изменений.
+"""
+import re
+from collections import Counter, namedtuple
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import select
+
+from models import (db, User, Role, Counterparty, CounterpartyType, PropertyObject, PropertyObjectType,
+                    PropertyObjectTypeEnum, ServiceType, ServiceTypeEnum, BusinessCategory,
+                    BusinessCategoryEnum, Contract, ContractStatus, Specification, SpecificationService,
+                    BillingType)
+
+# Лист книги -> статус импортируемых договоров
+SHEETS = {'Договор': ContractStatus.ACTIVE, 'Архив': ContractStatus.ARCHIVE}
+HEADER_MARK = 'ответственное лицо'
+EXTERNAL_PAVILION = 'внешняя компания'  # рекламодатель не арендует павильон
+SERVICE_DESCRIPTION = 'Размещение рекламы'
+CENTS = Decimal('0.01')
+
+COLUMNS = {
+    'manager': 'ответственное лицо',
+    'legal_form': 'ооо/ип',
+    'organization': 'организация',
+    'brand': 'бренд',
+    'pavilion': 'номер павильона',
+    'category': 'категория',
+    'contract_number': '№ договора',
+    'contract_date': 'дата договора',
+    'app_date': 'апп',
+    'specification': '№ спецификации',
+    'contacts': 'контакты',
+}
+MONTHS = ['январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
+          'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']
+MONTHS_GENITIVE = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+                   'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря']
+
+_DATE = (r'(?:(\d{1,2})\.+(\d{1,2})\.+(\d{4}|\d{2})(?!\d)'
+         r'|(\d{1,2})\s+(' + '|'.join(MONTHS_GENITIVE) + r')\s+(\d{4}))')
+DATE_RE = re.compile(_DATE, re.IGNORECASE)
+START_RE = re.compile(r'(?<!\w)(?:с|от)\s+' + _DATE, re.IGNORECASE)
+END_RE = re.compile(r'(?<!\w)(?:по|до)\s+' + _DATE, re.IGNORECASE)
+NUMBER_RE = re.compile(r'^\s*(.+?№\s*\d+)')
+
+PlacementRow = namedtuple('PlacementRow', [
+    'sheet', 'line', 'status', 'manager', 'counterparty_type', 'full_name', 'brand_name', 'notes',
+    'contacts', 'pavilion', 'category', 'contract_number', 'contract_date', 'app_date',
+    'spec_number', 'spec_start', 'spec_end', 'spec_text', 'amount',
+])
+
+
+class PlacementRowError(ValueError):
+    pass
+
+
+def _text(value):
+    return ' '.join(str(value).split()) if value is not None else ''
+
+
+def _key(value):
+    return _text(value).lower()
+
+
+def _date_from_match(groups):
+    day, month, year, word_day, word_month, word_year = groups
+    if day:
+        year = int(year)
+        return date(year + 2000 if year < 100 else year, int(month), int(day))
+    return date(int(word_year), MONTHS_GENITIVE.index(word_month.lower()) + 1, int(word_day))
+
+
+def parse_cell_date(value):
+    """Дата из ячейки: datetime Excel или строка вида «01.02.2025г.»"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    match = DATE_RE.search(_text(value))
+    if not match:
+        return None
+    try:
+        return _date_from_match(match.groups())
+    except ValueError:
+        return None
+
+
+def parse_amount(value):
+    """Сумма из ячейки: число или строка вида «52 500,00»"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return Decimal(str(round(value, 2))).quantize(CENTS)
+    cleaned = re.sub(r'[\s\xa0р.]+$', '', _text(value)).replace('\xa0', '').replace(' ', '').replace(',', '.')
+    try:
+        return Decimal(cleaned).quantize(CENTS)
+    except InvalidOperation:
+        return None
+
+
+def parse_specification(text):
+    """Номер и период спецификации из текста вида
+    «Спецификация № 1 с 01.07.2024 г. по 30.06.2025 г. (Доп. соглашение № 2 по 31.07.2025г.)».
+
+    Начало — дата после «с»/«от» в основной части, окончание — последняя дата после «по»/«до»,
+    то есть с учётом последнего дополнительного соглашения.
+    """
+    text = _text(text)
+    match = NUMBER_RE.match(text)
+    number = _text(match.group(1)) if match else None
+
+    start = None
+    start_match = START_RE.search(text.split('(')[0])
+    if start_match:
+        try:
+            start = _date_from_match(start_match.groups())
+        except ValueError:
+            pass
+
+    end = None
+    for end_match in END_RE.finditer(text):
+        try:
+            end = _date_from_match(end_match.groups())
+        except ValueError:
+            continue
+    return number, start, end
+
+
+def _monthly_amount(values):
+    """Регулярный платёж: самое частое ненулевое начисление (при равенстве — более позднее)."""
+    amounts = [amount for amount in map(parse_amount, reversed(values)) if amount]
+    if not amounts:
+        return None
+    return Counter(amounts).most_common(1)[0][0]
+
+
+def _header_index(header):
+    """Номера нужных колонок по заголовку листа."""
+    names = [_key(cell) for cell in header]
+    index = {}
+    for field, title in COLUMNS.items():
+        if title not in names:
+            raise PlacementRowError(f'нет колонки «{title}»')
+        index[field] = names.index(title)
+    index['charges'] = [i for i, name in enumerate(names)
+                        if 'начислен' in name and name.split()[0] in MONTHS]
+    return index
+
+
+def read_placement_rows(sheet, status, rows, errors):
+    """Разбирает строки листа в PlacementRow; ошибки складывает в errors и строку пропускает."""
+    index = None
+    for line, values in enumerate(rows, start=1):
+        if index is None:
+            if values and _key(values[0]) == HEADER_MARK:
+                try:
+                    index = _header_index(values)
+                except PlacementRowError as exc:
+                    errors.append(f'{sheet}: {exc}')
+                    return
+            continue
+        cell = lambda field: values[index[field]] if index[field] < len(values) else None
+        contract_number = _text(cell('contract_number'))
+        if not contract_number:
+            continue
+        try:
+            yield _parse_row(sheet, line, status, cell, contract_number,
+                             [values[i] for i in index['charges'] if i < len(values)])
+        except PlacementRowError as exc:
+            errors.append(f'{sheet}, строка {line} ({contract_number}): {exc}')
+
+
+def _parse_row(sheet, line, status, cell, contract_number, charges):
+    manager = _text(cell('manager'))
+    organization = _text(cell('organization'))
+    brand = _text(cell('brand')) or organization
+    if not manager:
+        raise PlacementRowError('не указано ответственное лицо')
+    if not organization:
+        raise PlacementRowError('не указана организация')
+
+    contract_date = parse_cell_date(cell('contract_date'))
+    if contract_date is None:
+        raise PlacementRowError('не распознана дата договора')
+    app_date = parse_cell_date(cell('app_date'))
+
+    spec_text = _text(cell('specification'))
+    spec_number, spec_start, spec_end = parse_specification(spec_text)
+    if spec_number is None:
+        raise PlacementRowError(f'не распознан номер спецификации «{spec_text}»')
+    spec_start = spec_start or app_date or contract_date
+    if spec_end is None:
+        raise PlacementRowError(f'не распознана дата окончания спецификации «{spec_text}»')
+    if spec_end < spec_start:
+        raise PlacementRowError(f'спецификация заканчивается раньше, чем начинается: «{spec_text}»')
+
+    # Организационные формы кроме ИП сводим к юрлицу, исходную форму и категорию сохраняем в заметках
+    legal_form = _text(cell('legal_form'))
+    counterparty_type = CounterpartyType.IP if legal_form == CounterpartyType.IP.value else CounterpartyType.LLC
+    notes = []
+    if legal_form and legal_form not in (item.value for item in CounterpartyType):
+        notes.append(f'Организационная форма: {legal_form}')
+    category_text = _text(cell('category'))
+    category = match_category(category_text)
+    if category_text and category_text.lower() != category.value.lower():
+        notes.append(f'Категория: {category_text}')
+
+    pavilion = _text(cell('pavilion'))
+    contacts = [part.strip() for part in _text(cell('contacts')).split(',') if part.strip()]
+
+    return PlacementRow(
+        sheet=sheet, line=line, status=status, manager=manager,
+        counterparty_type=counterparty_type, full_name=organization, brand_name=brand,
+        notes='\n'.join(notes) or None, contacts=contacts or None,
+        pavilion=None if pavilion.lower() == EXTERNAL_PAVILION else pavilion or None,
+        category=category, contract_number=contract_number, contract_date=contract_date,
+        app_date=app_date, spec_number=spec_number, spec_start=spec_start, spec_end=spec_end,
+        spec_text=spec_text, amount=_monthly_amount(charges),
+    )
+
+
+def match_category(text):
+    """Категория бизнеса по тексту из книги: точное совпадение, затем по первому слову, иначе «Другое»."""
+    text = _key(text)
+    for item in BusinessCategoryEnum:
+        if item.value.lower() == text:
+            return item
+    first_word = re.split(r'[\s,/]+', text)[0] if text else ''
+    if first_word:
+        for item in BusinessCategoryEnum:
+            if re.split(r'[\s,/]+', item.value.lower())[0] == first_word:
+                return item
+    return BusinessCategoryEnum.OTHER
+
+
+class PlacementImporter:
+    """Пакетный импорт строк книги размещений."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = Counter()
+        self.diff = []  # строки плана: «+» новое, «~» расхождение с уже существующим
+        self.missing_managers = Counter()  # имя менеджера -> пропущено строк
+        self._temp_id = 0
+        self._load_lookups()
+
+    def _load_lookups(self):
+        session = db.session
+        self.managers = {_key(name): id for id, name in session.execute(
+            select(User.id, User.name).where(User.role == Role.MANAGER))}
+        self.categories = dict(session.execute(select(BusinessCategory.name, BusinessCategory.id)).all())
+        self.pavilion_type_id = session.execute(select(PropertyObjectType.id).where(
+            PropertyObjectType.name == PropertyObjectTypeEnum.PAVILION)).scalar()
+        self.placement_type_id = session.execute(select(ServiceType.id).where(
+            ServiceType.name == ServiceTypeEnum.PLACEMENT)).scalar()
+        if not self.categories or self.pavilion_type_id is None or self.placement_type_id is None:
+            raise RuntimeError('Справочники не заполнены, сначала выполните flask init-db.')
+
+        self.counterparties = {(_key(full_name), _key(brand_name)): id for id, full_name, brand_name in
+                               session.execute(select(Counterparty.id, Counterparty.full_name,
+                                                      Counterparty.brand_name))}
+        self.property_objects = {_key(name): id for id, name in
+                                 session.execute(select(PropertyObject.id, PropertyObject.name))}
+        self.contracts = {row.number: row for row in session.execute(
+            select(Contract.id, Contract.number, Contract.date, Contract.status))}
+        self.specifications = {(row.contract_id, row.number): row for row in session.execute(
+            select(Specification.id, Specification.contract_id, Specification.number,
+                   Specification.start_date, Specification.end_date))}
+        self.services = {(row.specification_id, row.property_object_id): row.amount for row in session.execute(
+            select(SpecificationService.specification_id, SpecificationService.property_object_id,
+                   SpecificationService.amount)
+            .where(SpecificationService.service_type_id == self.placement_type_id))}
+
+    def run(self, rows, batch_size=500):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self._import_batch(batch)
+                batch = []
+        if batch:
+            self._import_batch(batch)
+
+    def _insert(self, model, rows, key=None, lookup=None):
+        """Пакетная вставка строк уровня; id новых строк раскладываются в lookup по ключу."""
+        if not rows:
+            return
+        self.created[model.__name__] += len(rows)
+        if self.dry_run:
+            for values in rows:
+                self._temp_id -= 1
+                if lookup is not None:
+                    lookup[key(values)] = self._temp_id
+            return
+        table = model.__table__
+        if lookup is None:
+            db.session.execute(table.insert(), rows)
+            return
+        result = db.session.execute(table.insert().returning(*table.c), rows)
+        for inserted in result.mappings():
+            lookup[key(inserted)] = inserted['id']
+
+    def _import_batch(self, batch):
+        rows = []
+        for row in batch:
+            if _key(row.manager) not in self.managers:
+                self.missing_managers[row.manager] += 1
+            else:
+                rows.append(row)
+
+        # 1. Контрагенты и объекты (павильоны) — не зависят от остальных
+        new_counterparties = {}
+        new_objects = {}
+        for row in rows:
+            key = (_key(row.full_name), _key(row.brand_name))
+            if key not in self.counterparties and key not in new_counterparties:
+                new_counterparties[key] = {
+                    'type': row.counterparty_type, 'full_name': row.full_name,
+                    'brand_name': row.brand_name, 'contacts': row.contacts, 'notes': row.notes,
+                }
+                self.diff.append(f'+ Контрагент {row.brand_name} ({row.full_name})')
+            if row.pavilion and _key(row.pavilion) not in self.property_objects \
+                    and _key(row.pavilion) not in new_objects:
+                new_objects[_key(row.pavilion)] = {'name': row.pavilion, 'type_id': self.pavilion_type_id}
+                self.diff.append(f'+ Объект {row.pavilion}')
+        self._insert(Counterparty, list(new_counterparties.values()),
+                     lambda v: (_key(v['full_name']), _key(v['brand_name'])), self.counterparties)
+        self._insert(PropertyObject, list(new_objects.values()), lambda v: _key(v['name']), self.property_objects)
+
+        # 2. Договоры
+        new_contracts = {}
+        for row in rows:
+            existing = self.contracts.get(row.contract_number)
+            if existing is not None:
+                if existing.date != row.contract_date:
+                    self.diff.append(f'~ Договор {row.contract_number}: дата {existing.date:%d/%m/%Y} '
+                                     f'в базе, {row.contract_date:%d/%m/%Y} в файле')
+                continue
+            if row.contract_number in new_contracts:
+                continue
+            new_contracts[row.contract_number] = {
+                'number': row.contract_number, 'date': row.contract_date, 'app_end_date': row.app_date,
+                'pavilion_number': row.pavilion, 'status': row.status,
+                'counterparty_id': self.counterparties[(_key(row.full_name), _key(row.brand_name))],
+                'manager_id': self.managers[_key(row.manager)],
+                'category_id': self.categories[row.category],
+            }
+            self.diff.append(f'+ Договор {row.contract_number} от {row.contract_date:%d/%m/%Y} '
+                             f'({row.brand_name}, {row.status.value})')
+        contract_ids = {}
+        self._insert(Contract, list(new_contracts.values()), lambda v: v['number'], contract_ids)
+        for number, id in contract_ids.items():
+            values = new_contracts[number]
+            self.contracts[number] = _ContractInfo(id, number, values['date'], values['status'])
+
+        # 3. Спецификации
+        new_specifications = {}
+        for row in rows:
+            contract_id = self.contracts[row.contract_number].id
+            key = (contract_id, row.spec_number)
+            existing = self.specifications.get(key)
+            if existing is not None:
+                if (existing.start_date, existing.end_date) != (row.spec_start, row.spec_end):
+                    self.diff.append(
+                        f'~ {row.contract_number} / {row.spec_number}: период '
+                        f'{existing.start_date:%d/%m/%Y}–{existing.end_date:%d/%m/%Y} в базе, '
+                        f'{row.spec_start:%d/%m/%Y}–{row.spec_end:%d/%m/%Y} в файле')
+                continue
+            if key in new_specifications:
+                continue
+            new_specifications[key] = {
+                'number': row.spec_number, 'start_date': row.spec_start, 'end_date': row.spec_end,
+                'description': row.spec_text, 'contract_id': contract_id,
+            }
+            self.diff.append(f'+ {row.contract_number} / {row.spec_number}: '
+                             f'{row.spec_start:%d/%m/%Y}–{row.spec_end:%d/%m/%Y}')
+        specification_ids = {}
+        self._insert(Specification, list(new_specifications.values()),
+                     lambda v: (v['contract_id'], v['number']), specification_ids)
+        for key, id in specification_ids.items():
+            values = new_specifications[key]
+            self.specifications[key] = _SpecificationInfo(id, key[0], key[1], values['start_date'], values['end_date'])
+
+        # 4. Ежемесячные услуги размещения
+        new_services = {}
+        for row in rows:
+            if row.amount is None:
+                continue
+            specification = self.specifications[(self.contracts[row.contract_number].id, row.spec_number)]
+            object_id = self.property_objects.get(_key(row.pavilion)) if row.pavilion else None
+            key = (specification.id, object_id)
+            if key in self.services:
+                if self.services[key] != row.amount:
+                    self.diff.append(f'~ {row.contract_number} / {row.spec_number}: сумма размещения '
+                                     f'{self.services[key]} в базе, {row.amount} в файле')
+                continue
+            if key in new_services:
+                continue
+            new_services[key] = {
+                'description': SERVICE_DESCRIPTION, 'billing_type': BillingType.MONTHLY,
+                'start_date': specification.start_date, 'end_date': specification.end_date,
+                'amount': row.amount, 'specification_id': specification.id,
+                'property_object_id': object_id, 'service_type_id': self.placement_type_id,
+            }
+            self.diff.append(f'+ {row.contract_number} / {row.spec_number}: размещение {row.amount} в месяц')
+        self._insert(SpecificationService, list(new_services.values()))
+        for key, values in new_services.items():
+            self.services[key] = values['amount']
+        if not self.dry_run:
+            db.session.commit()
+
+
+_ContractInfo = namedtuple('_ContractInfo', 'id number date status')
+_SpecificationInfo = namedtuple('_SpecificationInfo', 'id contract_id number start_date end_date')
+
+
+def iter_workbook_rows(path, sheets, errors):
+    """Строки выбранных листов книги, прочитанные потоком."""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet in sheets:
+            if sheet not in workbook.sheetnames:
+                errors.append(f'Лист «{sheet}» не найден')
+                continue
+            yield from read_placement_rows(sheet, SHEETS[sheet], workbook[sheet].iter_rows(values_only=True), errors)
+    finally:
+        workbook.close()
@@ -0,0 +1,248 @@
+"""Отчёты для финансов.
+
+Дебиторка считается агрегатным запросом и кэшируется через dictionaries.py:
+кэш сбрасывается после commit, изменившего реализации или платежи.
+P&L читается из помесячного свода PnlRollup, который пересчитывается
+по затронутым месяцам при commit.
+"""
+from collections import namedtuple
+from datetime import date, timedelta
+from decimal import Decimal
+
+from sqlalchemy import select, insert, delete, case, func, literal, null, union_all, and_, or_, tuple_, event, inspect
+from sqlalchemy.orm import Session
+
+from models import (db, User, Counterparty, Contract, Realization, RealizationService, Payment, PnlRollup,
+                    payment_realization_association)
+from dictionaries import dictionary, get_dictionary, invalidate_dictionaries
+
+# Корзины просрочки: (заголовок, максимальный возраст в днях; None — без ограничения)
+AGING_BUCKETS = (('0–30', 30), ('31–60', 60), ('61–90', 90), ('90+', None))
+
+AgingRow = namedtuple('AgingRow', 'id name buckets total advance')
+AgingReport = namedtuple('AgingReport', 'as_of by_counterparty by_manager totals advance_total')
+
+
+def _aging_query(as_of):
+    """Долги по корзинам и авансы одним агрегатным запросом, по парам (контрагент, менеджер).
+
+    Строки авансов идут с пустым менеджером: аванс принадлежит контрагенту.
+    """
+    debt = Realization.debt_amount
+    bounds = [as_of - timedelta(days=days) for _, days in AGING_BUCKETS[:-1]]
+    bucket_columns = []
+    for index in range(len(AGING_BUCKETS)):
+        conditions = []
+        if index < len(bounds):
+            conditions.append(Realization.date >= bounds[index])
+        if index > 0:
+            conditions.append(Realization.date < bounds[index - 1])
+        bucket_columns.append(case((db.and_(*conditions), debt), else_=0).label(f'bucket_{index}'))
+
+    debts = select(
+        Realization.counterparty_id, Realization.manager_id, *bucket_columns, literal(0).label('advance'),
+    ).where(debt > 0)
+    advances = select(
+        Payment.counterparty_id, null().label('manager_id'),
+        *[literal(0).label(f'bucket_{index}') for index in range(len(AGING_BUCKETS))],
+        Payment.unallocated_amount.label('advance'),
+    ).where(Payment.unallocated_amount > 0)
+    rows = union_all(debts, advances).subquery()
+
+    return (
+        select(
+            rows.c.counterparty_id, Counterparty.brand_name, rows.c.manager_id, User.name.label('manager_name'),
+            *[func.sum(rows.c[f'bucket_{index}']).label(f'bucket_{index}') for index in range(len(AGING_BUCKETS))],
+            func.sum(rows.c.advance).label('advance'),
+        )
+        .join(Counterparty, Counterparty.id == rows.c.counterparty_id)
+        .outerjoin(User, User.id == rows.c.manager_id)
+        .group_by(rows.c.counterparty_id, Counterparty.brand_name, rows.c.manager_id, User.name)
+    )
+
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+
+def _sorted_rows(groups):
+    rows = [AgingRow(id, name, buckets, sum(buckets, Decimal('0')), advance)
+            for id, (name, buckets, advance) in groups.items()]
+    return sorted(rows, key=lambda row: (-row.total, -row.advance, row.name or ''))
+
+
+@dictionary('aging', Realization, Payment, payment_realization_association)
+def build_aging_report(as_of=None):
+    """Дебиторка по срокам на дату as_of (по умолчанию сегодня): по контрагентам и по менеджерам."""
+    as_of = as_of or date.today()
+    by_counterparty, by_manager = {}, {}
+    bucket_count = len(AGING_BUCKETS)
+    for row in db.session.execute(_aging_query(as_of)):
+        buckets = [_money(row._mapping[f'bucket_{index}']) for index in range(bucket_count)]
+        advance = _money(row.advance)
+
+        name, counterparty_buckets, counterparty_advance = by_counterparty.get(
+            row.counterparty_id, (row.brand_name, [Decimal('0')] * bucket_count, Decimal('0')))
+        by_counterparty[row.counterparty_id] = (
+            name, [a + b for a, b in zip(counterparty_buckets, buckets)], counterparty_advance + advance)
+
+        # Строки только с авансом (без менеджера) в разрез по менеджерам не попадают
+        if any(buckets):
+            name, manager_buckets, _ = by_manager.get(
+                row.manager_id, (row.manager_name, [Decimal('0')] * bucket_count, Decimal('0')))
+            by_manager[row.manager_id] = (name, [a + b for a, b in zip(manager_buckets, buckets)], Decimal('0'))
+
+    counterparties = _sorted_rows(by_counterparty)
+    totals = [sum(column, Decimal('0')) for column in zip(*(row.buckets for row in counterparties))] \
+        or [Decimal('0')] * bucket_count
+    return AgingReport(
+        as_of=as_of,
+        by_counterparty=counterparties,
+        by_manager=_sorted_rows(by_manager),
+        totals=totals,
+        advance_total=sum((row.advance for row in counterparties), Decimal('0')),
+    )
+
+
+def get_aging_report():
+    """Отчёт из кэша; при смене дня пересчитывается, так как сдвигаются корзины."""
+    report = get_dictionary('aging')
+    if report.as_of != date.today():
+        invalidate_dictionaries('aging')
+        report = get_dictionary('aging')
+    return report
+
+
+# --- Свод P&L ---
+
+# Измерения отчёта P&L: параметр group -> колонка свода
+PNL_DIMENSIONS = {
+    'month': (PnlRollup.year, PnlRollup.month),
+    'manager': (PnlRollup.manager_id,),
+    'category': (PnlRollup.category_id,),
+    'service_type': (PnlRollup.service_type_id,),
+    'property_object': (PnlRollup.property_object_id,),
+}
+
+
+def _month_start(year, month):
+    return date(year, month, 1)
+
+
+def _next_month_start(year, month):
+    return date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+
+
+def _pnl_source_query():
+    """Агрегат услуг реализаций по измерениям свода (год и месяц — по дате реализации)."""
+    year = func.extract('year', Realization.date)
+    month = func.extract('month', Realization.date)
+    return (
+        select(
+            year, month, Realization.manager_id, Contract.category_id,
+            RealizationService.service_type_id, RealizationService.property_object_id,
+            func.sum(RealizationService.sale_amount),
+            func.sum(func.coalesce(RealizationService.expense_amount, 0)),
+            func.count(RealizationService.id),
+        )
+        .join(Realization, Realization.id == RealizationService.realization_id)
+        .outerjoin(Contract, Contract.id == Realization.contract_id)
+        .group_by(year, month, Realization.manager_id, Contract.category_id,
+                  RealizationService.service_type_id, RealizationService.property_object_id)
+    )
+
+
+def refresh_pnl_rollup(months=None, session=None):
+    """Пересчитывает свод за месяцы [(year, month), ...] или целиком, если months не передан.
+
+    Два запроса независимо от числа месяцев: DELETE строк свода и INSERT ... SELECT из услуг.
+    Возвращает число строк свода, вставленных заново.
+    """
+    session = session or db.session
+    source = _pnl_source_query()
+    clear = delete(PnlRollup)
+    if months is not None:
+        months = sorted(set(months))
+        if not months:
+            return 0
+        clear = clear.where(tuple_(PnlRollup.year, PnlRollup.month).in_(months))
+        source = source.where(or_(*(
+            and_(Realization.date >= _month_start(year, month), Realization.date < _next_month_start(year, month))
+            for year, month in months
+        )))
+    session.execute(clear)
+    result = session.execute(insert(PnlRollup).from_select(
+        ['year', 'month', 'manager_id', 'category_id', 'service_type_id', 'property_object_id',
+         'sale_amount', 'expense_amount', 'services_count'],
+        source,
+    ))
+    return result.rowcount
+
+
+def mark_pnl_months(session, months):
+    """Отмечает месяцы для пересчёта свода при commit (для записи через Core в обход unit of work)."""
+    session.info.setdefault('pnl_months', set()).update(months)
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_pnl_months(session, flush_context, instances):
+    """Запоминает месяцы, чьи строки свода затронуты реализациями, услугами или категорией договора."""
+    months = set()
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, RealizationService):
+                realization = obj.realization
+                if realization is None and obj.realization_id is not None:
+                    realization = session.get(Realization, obj.realization_id)
+                if realization is not None and realization.date is not None:
+                    months.add((realization.date.year, realization.date.month))
+            elif isinstance(obj, Realization):
+                # Месяц до и после изменения даты
+                history = inspect(obj).attrs.date.history
+                for value in [obj.date, *history.deleted]:
+                    if value is not None:
+                        months.add((value.year, value.month))
+            elif isinstance(obj, Contract) and obj in session.dirty and inspect(obj).attrs.category_id.history.deleted:
+                rows = session.execute(
+                    select(Realization.date).where(Realization.contract_id == obj.id).distinct())
+                months.update((value.year, value.month) for value, in rows)
+    if months:
+        mark_pnl_months(session, months)
+
+
+@event.listens_for(Session, 'before_commit')
+def _refresh_pnl_months(session):
+    # before_commit вызывается до финального flush: сбрасываем изменения сами, чтобы собрать месяцы
+    session.flush()
+    months = session.info.pop('pnl_months', None)
+    if months:
+        refresh_pnl_rollup(months, session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_pnl_months(session):
+    session.info.pop('pnl_months', None)
+
+
+def build_pnl_report(group_by, filters):
+    """Строки P&L из свода: суммы по выбранным измерениям с фильтрами.
+
+    filters: month_from/month_to — (year, month), manager_id, category_id, service_type_id, property_object_id.
+    """
+    columns = [column for name in group_by for column in PNL_DIMENSIONS[name]]
+    query = select(
+        *columns,
+        func.sum(PnlRollup.sale_amount).label('sale'),
+        func.sum(PnlRollup.expense_amount).label('expense'),
+        func.sum(PnlRollup.services_count).label('services_count'),
+    )
+    if 'month_from' in filters:
+        query = query.where(tuple_(PnlRollup.year, PnlRollup.month) >= tuple_(*filters['month_from']))
+    if 'month_to' in filters:
+        query = query.where(tuple_(PnlRollup.year, PnlRollup.month) <= tuple_(*filters['month_to']))
+    for name in ('manager_id', 'category_id', 'service_type_id', 'property_object_id'):
+        if name in filters:
+            query = query.where(getattr(PnlRollup, name) == filters[name])
+    if columns:
+        query = query.group_by(*columns).order_by(*columns)
+    return db.session.execute(query).all()
@@ -0,0 +1,164 @@
+"""Журнал медленных SQL-запросов (включается SLOW_QUERY_MS > 0).
+
+Каждый запрос дольше порога пишется в ротируемый файл SLOW_QUERY_LOG одной
+JSON-строкой: время выполнения, SQL и параметры, маршрут и form_type
+HTTP-запроса (или команда CLI) и план — EXPLAIN QUERY PLAN в SQLite, EXPLAIN
+в PostgreSQL. План снимается сразу, отдельным курсором драйвера на том же
+соединении (события SQLAlchemy для него не срабатывают) и с теми же
+параметрами, в PostgreSQL — под SAVEPOINT; для executemany и DDL план не
+снимается.
+
+Сводка по журналу — flask slow-queries --top 20 (summarize()).
+"""
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import click
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from instrumentation import normalize_sql
+
+logger = logging.getLogger('slow_queries')
+logger.propagate = False
+
+_EXPLAIN = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN '}
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+_threshold_ms = 0
+
+
+def _source():
+    """Маршрут и form_type HTTP-запроса, выполнившего SQL; вне запроса — команда CLI."""
+    if has_request_context():
+        form_type = request.form.get('form_type') if request.method == 'POST' else None
+        return {'route': f'{request.method} {request.url_rule.rule if request.url_rule else request.path}',
+                'form_type': form_type}
+    context = click.get_current_context(silent=True)
+    command = context.info_name if context else os.path.basename(sys.argv[0])
+    return {'route': f'cli {command}', 'form_type': None}
+
+
+def _jsonable(parameters):
+    if isinstance(parameters, dict):
+        return {key: _jsonable(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_jsonable(value) for value in parameters]
+    if parameters is None or isinstance(parameters, (bool, int, float)):
+        return parameters
+    return str(parameters)[:200]
+
+
+def _explain(conn, cursor, statement, parameters):
+    """Строки плана запроса или текст ошибки EXPLAIN."""
+    prefix = _EXPLAIN.get(conn.dialect.name)
+    if prefix is None:
+        return []
+    raw = cursor.connection
+    # В PostgreSQL ошибка внутри транзакции прерывает её целиком — EXPLAIN идёт под точкой
+    # сохранения, чтобы его сбой не ломал следующий запрос вызывающего кода
+    savepoint = conn.dialect.name == 'postgresql' and not getattr(raw, 'autocommit', False)
+    explain_cursor = raw.cursor()
+    try:
+        if savepoint:
+            explain_cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            # SQLite: (id, parent, notused, detail); PostgreSQL: одна колонка с текстом
+            plan = [str(row[-1]) for row in explain_cursor.fetchall()]
+        except conn.dialect.dbapi.Error as exc:
+            if savepoint:
+                explain_cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            plan = [f'EXPLAIN не выполнен: {exc}']
+        if savepoint:
+            explain_cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return plan
+    finally:
+        explain_cursor.close()
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    # Время начала — на контексте выполнения: он живёт один запрос, и при ошибке
+    # на соединении из пула не остаётся записи без пары
+    if context is not None:
+        context.slow_query_started = time.perf_counter()
+
+
+def _log_slow(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'slow_query_started', None)
+    if started is None:
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms < _threshold_ms:
+        return
+    explainable = not executemany and statement.lstrip().upper().startswith(_EXPLAINABLE)
+    entry = {
+        'at': datetime.now().isoformat(timespec='seconds'),
+        'ms': round(elapsed_ms, 1),
+        'statement': statement,
+        'parameters': _jsonable(parameters) if not executemany else f'executemany: {len(parameters)}',
+        **_source(),
+        'plan': _explain(conn, cursor, statement, parameters) if explainable else [],
+    }
+    logger.warning(json.dumps(entry, ensure_ascii=False))
+
+
+def init_app(app):
+    """Подключает журнал, если SLOW_QUERY_MS > 0."""
+    global _threshold_ms
+    app.config.setdefault('SLOW_QUERY_MS', 0)
+    app.config.setdefault('SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow_queries.log'))
+    app.config.setdefault('SLOW_QUERY_LOG_BYTES', 5 * 1024 * 1024)
+    app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+    if app.config['SLOW_QUERY_MS'] <= 0 or logger.handlers:
+        return
+    _threshold_ms = app.config['SLOW_QUERY_MS']
+    os.makedirs(os.path.dirname(app.config['SLOW_QUERY_LOG']), exist_ok=True)
+    handler = RotatingFileHandler(app.config['SLOW_QUERY_LOG'], maxBytes=app.config['SLOW_QUERY_LOG_BYTES'],
+                                  backupCount=app.config['SLOW_QUERY_LOG_BACKUPS'], encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.WARNING)
+    event.listen(Engine, 'before_cursor_execute', _start_timer)
+    event.listen(Engine, 'after_cursor_execute', _log_slow)
+
+
+def read_log(path, backups):
+    """Записи журнала вместе с ротированными файлами path.1 … path.N, от старых к новым."""
+    paths = [f'{path}.{number}' for number in range(backups, 0, -1)] + [path]
+    for name in paths:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(entries):
+    """Сводка по нормализованному SQL, по убыванию суммарного времени.
+
+    [{'sql', 'count', 'total_ms', 'max_ms', 'routes': {маршрут: число}, 'slowest': запись}]
+    """
+    groups = {}
+    for entry in entries:
+        sql = normalize_sql(entry['statement'])
+        group = groups.setdefault(sql, {
+            'sql': sql, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'routes': {}, 'slowest': entry,
+        })
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        route = entry['route'] + (f" [{entry['form_type']}]" if entry.get('form_type') else '')
+        group['routes'][route] = group['routes'].get(route, 0) + 1
+        if entry['ms'] >= group['max_ms']:
+            group['max_ms'] = entry['ms']
+            group['slowest'] = entry
+    return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
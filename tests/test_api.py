@@ -0,0 +1,62 @@
+from sqlalchemy import create_engine, text
+
+from models import db, Realization
+
+
+def fetch_all(client, url, limit):
+    ids, cursor = [], None
+    while True:
+        page = client.get(url, query_string={'limit': limit, 'cursor': cursor} if cursor else {'limit': limit}).json
+        ids += [item['id'] for item in page['data']]
+        cursor = page['next_cursor']
+        if not cursor:
+            return ids
+
+
+def test_cursor_pagination_covers_every_row_once(client, generated):
+    ids = fetch_all(client, '/api/v1/realizations', 4)
+    assert ids == sorted(r.id for r in Realization.query)
+
+
+def test_realization_totals_and_payment_allocations(client, generated):
+    first = Realization.query.filter_by(counterparty_id=1).order_by(Realization.id).first()
+    client.post('/payments', data={'form_type': 'create_payment', 'date': '01/04/2025', 'counterparty_id': '1',
+                                   'payment_type': 'CASH', 'amount': '400', 'realization_ids': [str(first.id)]})
+
+    realization = client.get('/api/v1/realizations?fields=id,total_sale,paid_amount,debt,payment_status').json['data'][0]
+    assert realization == {'id': first.id, 'total_sale': 1000.0, 'paid_amount': 400.0, 'debt': 600.0,
+                           'payment_status': 'PARTIALLY_PAID'}
+    payment = client.get('/api/v1/payments?fields=initial_amount,allocations').json['data'][0]
+    assert payment == {'initial_amount': 400.0, 'allocations': [
+        {'realization_id': first.id, 'realization_number': first.number, 'amount': 400.0}]}
+
+
+def test_invalid_parameters(client, contracts):
+    assert client.get('/api/v1/contracts?fields=nope').status_code == 400
+    response = client.get('/api/v1/contracts?limit=abc')
+    assert response.status_code == 400
+    assert 'limit' in response.json['error']
+    assert client.get('/api/v1/contracts?cursor=zzz').status_code == 400
+
+
+def test_conditional_get(client, contracts):
+    response = client.get('/api/v1/counterparties')
+    etag = response.headers['ETag']
+    assert client.get('/api/v1/counterparties', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/v1/counterparties?fields=id', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_etag_changes_after_write_from_another_connection(client, contracts):
+    etag = client.get('/api/v1/counterparties').headers['ETag']
+    db.session.commit()  # закрыть транзакцию чтения, иначе SQLite держит снимок
+
+    # Отдельный движок: ни событий сессии, ни общего кэша процесса
+    other = create_engine(db.engine.url.render_as_string(hide_password=False))
+    with other.begin() as conn:
+        conn.execute(text("UPDATE counterparty SET notes = 'изменено' WHERE id = 1"))
+    other.dispose()
+
+    response = client.get('/api/v1/counterparties', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.json['data'][0]['notes'] == 'изменено'
@@ -0,0 +1,17 @@
+def test_benchmark_requires_baseline(app, tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    result = app.test_cli_runner().invoke(args=['benchmark', '--sizes', '2x2x1', '--baseline', str(baseline)])
+    assert result.exit_code != 0
+    assert '--update-baseline' in result.output
+    assert not baseline.exists()
+
+
+def test_benchmark_update_baseline_then_compare(app, tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    runner = app.test_cli_runner()
+    args = ['benchmark', '--sizes', '2x2x1', '--repeat', '1', '--baseline', str(baseline)]
+    assert runner.invoke(args=args + ['--update-baseline']).exit_code == 0
+    assert baseline.exists()
+    # Время на крошечном наборе шумит — сравнение проверяет число запросов
+    result = runner.invoke(args=args + ['--threshold', '1000'])
+    assert result.exit_code == 0, result.output
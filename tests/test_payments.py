@@ -0,0 +1,54 @@
+from decimal import Decimal
+
+from models import db, Payment, PaymentStatus, Realization, payment_realization_association
+
+
+def debts(counterparty_id):
+    return Realization.query.filter_by(counterparty_id=counterparty_id).order_by(Realization.id).all()
+
+
+def create_payment(client, counterparty_id, amount, realization_ids=()):
+    return client.post('/payments', data={
+        'form_type': 'create_payment', 'date': '01/04/2025', 'counterparty_id': str(counterparty_id),
+        'payment_type': 'NON_CASH', 'amount': str(amount), 'realization_ids': [str(id) for id in realization_ids],
+    })
+
+
+def test_payment_allocates_in_selected_order(client, generated):
+    first, second = debts(1)
+    response = create_payment(client, 1, '1100', [first.id, second.id])
+    assert response.status_code == 302
+    db.session.expire_all()
+
+    assert [(r.paid_amount, r.payment_status) for r in debts(1)] == [
+        (first.total_sale, PaymentStatus.PAID),
+        (Decimal('1100') - first.total_sale, PaymentStatus.PARTIALLY_PAID),
+    ]
+    payment = Payment.query.one()
+    assert payment.unallocated_amount == 0
+    assert db.session.query(payment_realization_association).count() == 2
+
+
+def test_delete_payment_reverts_allocations(client, generated):
+    create_payment(client, 1, '1250', [r.id for r in debts(1)])
+    payment = Payment.query.one()
+    assert client.post(f'/delete-payment/{payment.id}').status_code == 302
+    db.session.expire_all()
+
+    assert Payment.query.count() == 0
+    assert db.session.query(payment_realization_association).count() == 0
+    assert [(r.paid_amount, r.payment_status) for r in debts(1)] == [(0, PaymentStatus.NOT_PAID)] * 2
+
+
+def test_advance_is_allocated_oldest_first(client, generated):
+    create_payment(client, 2, '1500')
+    assert Payment.query.one().unallocated_amount == Decimal('1500')
+
+    response = client.post('/payments', data={'form_type': 'allocate_advances', 'counterparty_id': '2'})
+    assert response.status_code == 302
+    db.session.expire_all()
+
+    assert sum(r.paid_amount for r in debts(2)) == Decimal('1250')
+    assert {r.payment_status for r in debts(2)} == {PaymentStatus.PAID}
+    assert Payment.query.one().unallocated_amount == Decimal('250')
+    assert {r.payment_status for r in debts(1)} == {PaymentStatus.NOT_PAID}
@@ -0,0 +1,67 @@
+"""Планы горячих запросов: EXPLAIN QUERY PLAN на свежей схеме SQLite.
+
+Запросы собираются теми же функциями, что и на страницах, поэтому изменение кода
+или индексов, из-за которого SQLite перестаёт использовать индекс, роняет тест.
+"""
+from datetime import date
+
+import pytest
+from sqlalchemy import select, text
+
+from app import (keyset_query, realizations_list_query, payments_list_query, contracts_list_query,
+                 month_candidates_query, outstanding_realizations_query, open_advances_query)
+from models import db, Realization, RealizationService, Payment, Contract, Counterparty, PaymentStatus
+
+
+def page(query, sort_columns):
+    return keyset_query(query, sort_columns, descending=True)
+
+
+REALIZATION_SORT = [Realization.date, Realization.id]
+
+# (название, построитель запроса, индексы, которые должны быть в плане)
+CHECKS = [
+    ('realizations', lambda: page(realizations_list_query({}), REALIZATION_SORT), ['ix_realization_date']),
+    ('realizations-period', lambda: page(realizations_list_query(
+        {'date_from': date(2025, 1, 1), 'date_to': date(2025, 12, 31)}), REALIZATION_SORT),
+     ['ix_realization_date']),
+    ('realizations-counterparty', lambda: page(realizations_list_query({'counterparty_id': 1}), REALIZATION_SORT),
+     ['ix_realization_counterparty_date']),
+    ('realizations-manager', lambda: page(realizations_list_query({'manager_id': 1}), REALIZATION_SORT),
+     ['ix_realization_manager_date']),
+    ('realizations-status', lambda: page(realizations_list_query(
+        {'payment_status': PaymentStatus.NOT_PAID}), REALIZATION_SORT),
+     ['ix_realization_status_date']),
+    ('realization-services',
+     lambda: select(RealizationService).where(RealizationService.realization_id.in_([1, 2])),
+     ['ix_realization_service_realization']),
+    ('generate-month', lambda: month_candidates_query(2025, 1),
+     ['ix_specification_contract_dates', 'ix_specification_service_spec_billing',
+      'ix_realization_spec_service_period']),
+    ('payments', lambda: page(payments_list_query({}), [Payment.date, Payment.id]), ['ix_payment_date']),
+    ('payments-counterparty', lambda: page(payments_list_query({'counterparty_id': 1}), [Payment.date, Payment.id]),
+     ['ix_payment_counterparty_date']),
+    ('outstanding-realizations',
+     lambda: outstanding_realizations_query().where(Realization.counterparty_id == 1),
+     ['ix_realization_counterparty_date']),
+    ('open-advances', lambda: open_advances_query(1), ['ix_payment_counterparty_date']),
+    ('contracts', lambda: page(contracts_list_query({}), [Contract.date, Contract.id]),
+     ['ix_contract_date', 'ix_specification_contract_dates', 'ix_realization_contract_period']),
+    ('contracts-counterparty', lambda: page(contracts_list_query({'counterparty_id': 1}), [Contract.date, Contract.id]),
+     ['ix_contract_counterparty_date']),
+    ('counterparties', lambda: keyset_query(Counterparty.query, [Counterparty.brand_name, Counterparty.id]),
+     ['ix_counterparty_brand_name']),
+]
+
+
+@pytest.mark.parametrize('build, indexes', [check[1:] for check in CHECKS], ids=[check[0] for check in CHECKS])
+def test_query_uses_index(app, build, indexes):
+    dialect = db.engine.dialect
+    if dialect.name != 'sqlite':
+        pytest.skip('EXPLAIN QUERY PLAN проверяется только на SQLite')
+    query = build()
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    plan = [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+    missing = [name for name in indexes if not any(f'INDEX {name} ' in f'{line} ' for line in plan)]
+    assert not missing, '\n'.join(plan)
@@ -0,0 +1,49 @@
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import select
+
+import reports
+from models import db, Realization, RealizationService, RealizationSource, PaymentStatus, PnlRollup
+
+
+def rollup_rows():
+    return sorted(
+        tuple(row) for row in db.session.execute(
+            select(PnlRollup.year, PnlRollup.month, PnlRollup.manager_id, PnlRollup.category_id,
+                   PnlRollup.service_type_id, PnlRollup.property_object_id, PnlRollup.sale_amount,
+                   PnlRollup.expense_amount, PnlRollup.services_count)))
+
+
+def test_generation_creates_realization_per_monthly_service(generated):
+    realizations = Realization.query.order_by(Realization.id).all()
+    assert len(realizations) == 6
+    assert {r.source for r in realizations} == {RealizationSource.AUTO}
+    assert {(r.year, r.month, r.date) for r in realizations} == {(2025, 3, date(2025, 3, 1))}
+    assert sorted(r.total_sale for r in realizations) == [Decimal('250.00')] * 3 + [Decimal('1000.00')] * 3
+    assert {r.payment_status for r in realizations} == {PaymentStatus.NOT_PAID}
+    assert RealizationService.query.count() == 6
+
+
+def test_generation_skips_existing_month(client, generated):
+    client.post('/generate-realizations', data={'month': '2025-03'})
+    assert Realization.query.count() == 6
+    client.post('/generate-realizations', data={'month': '2025-04'})
+    assert Realization.query.count() == 12
+
+
+def test_pnl_rollup_follows_changes(client, generated):
+    assert sum(row[6] for row in rollup_rows()) == Decimal('3750.00')
+
+    realization = Realization.query.filter(Realization.total_sale == 1000).first()
+    realization.date = date(2025, 5, 10)
+    db.session.commit()
+    service = RealizationService.query.first()
+    service.expense_amount = Decimal('100.00')
+    db.session.commit()
+
+    incremental = rollup_rows()
+    reports.refresh_pnl_rollup()
+    db.session.commit()
+    assert incremental == rollup_rows()
+    assert {(row[0], row[1]) for row in incremental} == {(2025, 3), (2025, 5)}